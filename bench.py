@@ -0,0 +1,229 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+import importlib
+import resource
+
+import httpx
+
+from mock_azure import MockReadApi, load_recordings
+
+# Offline benchmark: runs every file in the receipts corpus through simulated
+# Telegram download, OCR against a stub Azure Read API, and field extraction,
+# then reports per-stage latency percentiles, throughput and peak memory.
+#
+#   python bench.py --concurrency 16 --repeat 5
+#   python bench.py --record recordings     # one-off: save real Azure results for replay
+#   python bench.py --recordings recordings # replay them instead of synthetic text
+#   python bench.py --azure-url http://127.0.0.1:8081/  # go over HTTP to a running mock_azure.py
+#   python bench.py --azure-url http://127.0.0.1:8081/ --processes 4  # OCR in worker processes
+#   python bench.py --preprocess            # include image preprocessing (needs Pillow)
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bariflo_accounts_receipts")
+STUB_ENDPOINT = "http://azure.stub/"
+
+def load_corpus(directory):
+    files = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            with open(path, "rb") as f:
+                files.append((name, f.read()))
+    return files
+
+STAGES = ("download", "preprocess", "ocr", "extract", "total")
+
+# Serve the mock Read API through httpx's in-process transport, no sockets needed
+def mock_transport(api):
+    def handler(request):
+        query = {key: value for key, value in request.url.params.items()}
+        status, headers, payload = api.handle(request.method, request.url.path, query, request.headers, request.content)
+        return httpx.Response(status, headers=headers, json=payload)
+    return httpx.MockTransport(handler)
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+async def run_one(main, name, data, args, stats):
+    started = time.perf_counter()
+    # Telegram getFile + download: fixed round trip plus transfer time
+    await asyncio.sleep(args.download_latency + len(data) / (args.download_mbps * 125000))
+    downloaded = time.perf_counter()
+
+    try:
+        job, _ = await main.start_ocr(data)
+        text = await job
+    except main.OcrQueueFull:
+        # Also raised by the job itself when Azure keeps refusing it or it times out
+        stats["rejected"] += 1
+        return
+    read = time.perf_counter()
+
+    if text:
+        category = main.classify_receipt(text) or "PhonePe"
+        main.extract_limited_fields(text, category)
+    else:
+        stats["unreadable"] += 1
+    extracted = time.perf_counter()
+
+    stats["download"].append(downloaded - started)
+    # Includes preprocessing, which is also reported on its own
+    stats["ocr"].append(read - downloaded)
+    stats["extract"].append(extracted - read)
+    stats["total"].append(extracted - started)
+
+async def run_benchmark(main, corpus, args):
+    if not args.azure_url:
+        api = MockReadApi(load_recordings(args.recordings), args.ocr_latency, args.jitter,
+                          tps=args.tps, base_url=STUB_ENDPOINT)
+        main.http_client = httpx.AsyncClient(transport=mock_transport(api))
+    # Each repeat should pay for OCR again unless the cache is what is being measured
+    if not args.cache:
+        main.ocr_cache = main.OcrCache(0, 0)
+        main.disk_cache = None
+    stats = {stage: [] for stage in STAGES}
+    stats.update(rejected=0, unreadable=0)
+    if args.processes:
+        # Worker processes preprocess on their own threads, out of reach of the timing below
+        main.ocr_pool = main.ProcessOcrPool(args.processes, args.workers, max(args.queue_limit, 1))
+    else:
+        main.ocr_pool = main.OcrWorkerPool(args.workers, max(args.queue_limit, 1))
+        main.start_preprocess_pool()
+        if main.preprocess_pool is not None:
+            time_preprocess(main, stats["preprocess"])
+    main.ocr_pool.start()
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def bounded(name, data):
+        async with semaphore:
+            await run_one(main, name, data, args, stats)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(bounded(name, data) for _ in range(args.repeat) for name, data in corpus))
+    elapsed = time.perf_counter() - started
+
+    await main.ocr_pool.stop()
+    main.stop_preprocess_pool()
+    await main.close_http_client()
+    return stats, elapsed
+
+# Wrap main.preprocess, which extract_text_from_image looks up at call time, to time each image
+def time_preprocess(main, timings):
+    preprocess = main.preprocess
+
+    async def timed(image_bytes):
+        started = time.perf_counter()
+        try:
+            return await preprocess(image_bytes)
+        finally:
+            timings.append(time.perf_counter() - started)
+
+    main.preprocess = timed
+
+async def record(main, corpus, directory):
+    os.makedirs(directory, exist_ok=True)
+    # Recordings are keyed by the uploaded bytes, so they must be preprocessed as the bot would
+    main.start_preprocess_pool()
+    for name, data in corpus:
+        upload = data if data.startswith(b"%PDF") else await main.preprocess(data)
+        analyze_result = await main.analyze_image(upload)
+        if analyze_result is None:
+            print(f"  {name}: OCR failed, not recorded")
+            continue
+        digest = hashlib.sha256(upload).hexdigest()
+        with open(os.path.join(directory, f"{digest}.json"), "w") as f:
+            json.dump(analyze_result, f)
+        print(f"  {name}: saved {digest}.json")
+    main.stop_preprocess_pool()
+    await main.close_http_client()
+
+def report(stats, elapsed, completed, args):
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"Receipts: {completed} in {elapsed:.2f}s "
+          f"({completed / elapsed if elapsed else 0:.1f}/s) at concurrency {args.concurrency}, "
+          f"{args.workers} OCR workers" + (f" x {args.processes} processes" if args.processes else ""))
+    print(f"Rejected (queue full or Azure unavailable): {stats['rejected']}, unreadable: {stats['unreadable']}")
+    print(f"{'stage':<10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for stage in STAGES:
+        values = stats[stage]
+        if not values:
+            continue
+        row = [percentile(values, 50), percentile(values, 95), percentile(values, 99), max(values, default=0)]
+        print(f"{stage:<10}" + "".join(f"{value * 1000:>10.1f}" for value in row))
+    print(f"Peak RSS: {peak_kb / 1024:.1f} MB")
+    return {
+        "receipts": completed,
+        "elapsed": elapsed,
+        "throughput": completed / elapsed if elapsed else 0,
+        "rejected": stats["rejected"],
+        "unreadable": stats["unreadable"],
+        "peak_rss_kb": peak_kb,
+        "stages": {
+            stage: {f"p{pct}": percentile(stats[stage], pct) for pct in (50, 95, 99)}
+            for stage in STAGES if stats[stage]
+        },
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the receipt pipeline over the sample corpus.")
+    parser.add_argument("--corpus", default=CORPUS_DIR, help="directory of receipt files")
+    parser.add_argument("--concurrency", type=int, default=8, help="receipts in flight at once")
+    parser.add_argument("--repeat", type=int, default=3, help="passes over the corpus")
+    parser.add_argument("--workers", type=int, default=8, help="OCR worker pool size (per process with --processes)")
+    parser.add_argument("--processes", type=int, default=0, help="run OCR in this many worker processes (needs --azure-url)")
+    parser.add_argument("--queue-limit", type=int, default=1000, help="OCR queue depth")
+    parser.add_argument("--ocr-latency", type=float, default=1.5, help="stub Azure job duration in seconds")
+    parser.add_argument("--jitter", type=float, default=0.3, help="relative +/- jitter on the stub latency")
+    parser.add_argument("--tps", type=float, default=0, help="stub transactions per second before 429s (0 = unlimited)")
+    parser.add_argument("--azure-url", default="", help="use a running mock_azure.py at this URL instead of the in-process stub")
+    parser.add_argument("--download-latency", type=float, default=0.15, help="simulated getFile round trip in seconds")
+    parser.add_argument("--download-mbps", type=float, default=20.0, help="simulated download bandwidth")
+    parser.add_argument("--preprocess", action="store_true", help="preprocess images before upload (PREPROCESS_IMAGES=1)")
+    parser.add_argument("--cache", action="store_true", help="keep the OCR cache enabled between repeats")
+    parser.add_argument("--recordings", default="", help="directory of recorded analyzeResult JSON to replay")
+    parser.add_argument("--record", default="", help="call the real Azure endpoint and save results here")
+    parser.add_argument("--json", default="", help="also write the report as JSON to this file")
+    return parser.parse_args(argv)
+
+def run(argv=None):
+    args = parse_args(argv)
+    if not args.record:
+        # Never touch the real endpoint from .env while benchmarking
+        os.environ["AZURE_VISION_ENDPOINT"] = args.azure_url.rstrip("/") + "/" if args.azure_url else STUB_ENDPOINT
+        os.environ["AZURE_VISION_KEY"] = "stub"
+        # The bot's rate limiter matches the stub's tier (0 = both unlimited) unless set explicitly
+        os.environ.setdefault("AZURE_TPS", str(args.tps))
+    if args.processes and not args.azure_url:
+        sys.exit("--processes needs --azure-url: worker processes cannot reach the in-process stub")
+    if not args.cache:
+        # Worker processes build their own caches at import
+        os.environ["OCR_CACHE_SIZE"] = "0"
+        os.environ["OCR_CACHE_DB"] = ""
+    if args.preprocess:
+        os.environ["PREPROCESS_IMAGES"] = "1"
+    main = importlib.import_module("main")
+    corpus = load_corpus(args.corpus)
+    if not corpus:
+        sys.exit(f"No files found in {args.corpus}")
+
+    if args.record:
+        asyncio.run(record(main, corpus, args.record))
+        return
+
+    stats, elapsed = asyncio.run(run_benchmark(main, corpus, args))
+    summary = report(stats, elapsed, len(stats["total"]), args)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+
+if __name__ == "__main__":
+    run()
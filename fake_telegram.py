@@ -0,0 +1,341 @@
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+import itertools
+import resource
+from urllib.parse import urlsplit, parse_qs
+
+import httpx
+
+# Local stand-in for the Telegram Bot API endpoints the bot uses (getMe, deleteWebhook,
+# getUpdates, getFile, file download, sendMessage, editMessageText, answerCallbackQuery),
+# driving thousands of simulated users through the photo -> category -> UPI subtype flow
+# and reporting update throughput and per-step latency. Updates are served through
+# getUpdates, or POSTed to the bot once it has called setWebhook.
+#
+#   python mock_azure.py --port 8081 &
+#   python fake_telegram.py --port 8082 --users 2000 --ramp 20 &
+#   TELEGRAM_API_URL=http://127.0.0.1:8082 AZURE_VISION_ENDPOINT=http://127.0.0.1:8081/ python main.py
+#   ... RUN_MODE=webhook WEBHOOK_URL=http://127.0.0.1:8443 python main.py
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bariflo_accounts_receipts")
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".jfif", ".png")
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Receipt Bot", "username": "receipt_bot"}
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found"}
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+OUTCOMES = {"Category:": "result", "unclear": "unreadable", "Failed": "failed", "Too many": "rejected",
+            "send a receipt": "no session"}
+
+def outcome(text):
+    return next((name for marker, name in OUTCOMES.items() if marker in text), None)
+
+def is_final(text):
+    return outcome(text) is not None
+
+class FakeTelegram:
+    def __init__(self, corpus, unique_images=False):
+        self.corpus = corpus
+        self.unique_images = unique_images
+        self.files = {}
+        self.updates = []
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.callback_ids = itertools.count(1)
+        self.new_updates = asyncio.Event()
+        self.bot_connected = asyncio.Event()
+        self.inboxes = {}
+        self.calls = {}
+        self.delivered = 0
+        self.webhook = None
+        self.webhook_secret = None
+        self.webhook_client = None
+        self.posting = set()
+
+    # --- HTTP ---
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length") or 0))
+                status, content_type, payload = await self.route(method, urlsplit(target), headers, body)
+                writer.write(
+                    f"HTTP/1.1 {status} {REASONS.get(status, 'OK')}\r\n"
+                    f"Content-Type: {content_type}\r\nContent-Length: {len(payload)}\r\n\r\n".encode() + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # Open keep-alive connections are cancelled when the run finishes
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method, url, headers, body):
+        path = url.path
+        # /file/bot<token>/<file_path>
+        if path.startswith("/file/bot"):
+            data = self.files.get(path.rsplit("/", 1)[-1])
+            if data is None:
+                return 404, "text/plain", b"Not Found"
+            return 200, "application/octet-stream", data
+        # /bot<token>/<method>
+        if not path.startswith("/bot"):
+            return 404, "text/plain", b"Not Found"
+        api_method = path.rsplit("/", 1)[-1]
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        params.update(self.parse_params(headers, body))
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        handler = getattr(self, f"api_{api_method}", None)
+        try:
+            result = await handler(params) if handler else True
+        except KeyError as e:
+            error = {"ok": False, "error_code": 400, "description": f"Bad Request: {e.args[0]} is missing or unknown"}
+            return 400, "application/json", json.dumps(error).encode()
+        return 200, "application/json", json.dumps({"ok": True, "result": result}).encode()
+
+    def parse_params(self, headers, body):
+        if not body:
+            return {}
+        if headers.get("content-type", "").startswith("application/json"):
+            return json.loads(body)
+        params = {key: values[-1] for key, values in parse_qs(body.decode()).items()}
+        # PTB form-encodes nested objects as JSON strings
+        for key in ("reply_markup",):
+            if key in params:
+                params[key] = json.loads(params[key])
+        return params
+
+    # --- Bot API methods ---
+
+    async def api_getMe(self, params):
+        return BOT_USER
+
+    async def api_getUpdates(self, params):
+        self.bot_connected.set()
+        offset = int(params.get("offset") or 0)
+        if offset:
+            self.updates = [update for update in self.updates if update["update_id"] >= offset]
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+        if not self.updates and timeout:
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        batch = self.updates[:limit]
+        self.delivered = max(self.delivered, batch[-1]["update_id"] if batch else 0)
+        return batch
+
+    async def api_setWebhook(self, params):
+        self.webhook = params["url"]
+        self.webhook_secret = params.get("secret_token")
+        self.webhook_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=int(params.get("max_connections") or 40)), timeout=60
+        )
+        self.bot_connected.set()
+        return True
+
+    async def api_deleteWebhook(self, params):
+        self.webhook = None
+        return True
+
+    async def api_getFile(self, params):
+        file_id = params["file_id"]
+        return {"file_id": file_id, "file_unique_id": f"u{file_id}", "file_size": len(self.files[file_id]), "file_path": file_id}
+
+    async def api_sendMessage(self, params):
+        chat_id = int(params["chat_id"])
+        message = self.make_message(chat_id, BOT_USER, text=params.get("text", ""))
+        if isinstance(params.get("reply_markup"), dict) and "inline_keyboard" in params["reply_markup"]:
+            message["reply_markup"] = params["reply_markup"]
+        self.deliver(chat_id, ("send", message))
+        return message
+
+    async def api_editMessageText(self, params):
+        chat_id = int(params["chat_id"])
+        message = self.make_message(chat_id, BOT_USER, text=params.get("text", ""), message_id=int(params["message_id"]))
+        if isinstance(params.get("reply_markup"), dict):
+            message["reply_markup"] = params["reply_markup"]
+        self.deliver(chat_id, ("edit", message))
+        return message
+
+    async def api_answerCallbackQuery(self, params):
+        return True
+
+    # --- simulated users ---
+
+    def make_message(self, chat_id, sender, message_id=None, **fields):
+        message = {
+            "message_id": message_id or next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private", "first_name": f"User {chat_id}"},
+            "from": sender,
+        }
+        message.update(fields)
+        return message
+
+    def deliver(self, chat_id, event):
+        inbox = self.inboxes.get(chat_id)
+        if inbox is not None:
+            inbox.put_nowait(event)
+
+    def push_update(self, **fields):
+        update = dict(fields, update_id=next(self.update_ids))
+        if self.webhook:
+            task = asyncio.create_task(self.post_update(update))
+            self.posting.add(task)
+            task.add_done_callback(self.posting.discard)
+            return
+        self.updates.append(update)
+        self.new_updates.set()
+
+    async def post_update(self, update):
+        headers = {"X-Telegram-Bot-Api-Secret-Token": self.webhook_secret} if self.webhook_secret else {}
+        response = await self.webhook_client.post(self.webhook, json=update, headers=headers)
+        if response.status_code == 200:
+            self.delivered += 1
+
+    def send_photo(self, user):
+        _, data = random.choice(self.corpus)
+        file_id = f"photo{user['id']}-{next(self.message_ids)}"
+        # Bytes after the JPEG end marker are ignored by decoders but defeat the OCR cache
+        self.files[file_id] = data + user["id"].to_bytes(8, "big") if self.unique_images else data
+        photo = [{"file_id": file_id, "file_unique_id": f"u{file_id}", "width": 1280, "height": 1280,
+                  "file_size": len(self.files[file_id])}]
+        self.push_update(message=self.make_message(user["id"], user, photo=photo))
+
+    def press(self, user, message, data):
+        self.push_update(callback_query={
+            "id": str(next(self.callback_ids)),
+            "from": user,
+            "chat_instance": str(user["id"]),
+            "data": data,
+            "message": message,
+        })
+
+    async def next_event(self, inbox, timeout):
+        return await asyncio.wait_for(inbox.get(), timeout)
+
+    # photo -> "Choose the receipt type" keyboard -> upi -> "Choose UPI type" -> PhonePe -> result.
+    # Auto-detected results may replace the keyboard before any button is pressed.
+    async def user_flow(self, user_id, think, timeout, stats):
+        user = {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"}
+        inbox = self.inboxes[user_id] = asyncio.Queue()
+        try:
+            started = time.perf_counter()
+            self.send_photo(user)
+            keyboard = None
+            while keyboard is None:
+                kind, message = await self.next_event(inbox, timeout)
+                if "reply_markup" in message:
+                    keyboard = message
+            stats["photo_to_keyboard"].append(time.perf_counter() - started)
+
+            for choice in ("upi", "PhonePe"):
+                await asyncio.sleep(random.uniform(0, think))
+                if not inbox.empty():
+                    kind, message = inbox.get_nowait()
+                    if kind == "edit" and is_final(message["text"]):
+                        stats["auto"] += 1
+                        break
+                pressed = time.perf_counter()
+                self.press(user, keyboard, choice)
+                # Skip "#N in the queue" edits until the next keyboard or the result
+                message = {"text": ""}
+                while not (is_final(message["text"]) or "reply_markup" in message):
+                    kind, message = await self.next_event(inbox, timeout)
+                stats["press_to_reply"].append(time.perf_counter() - pressed)
+                if is_final(message["text"]):
+                    break
+                keyboard = message
+            stats["completed"] += 1
+            stats["flow"].append(time.perf_counter() - started)
+            name = outcome(message["text"])
+            stats["outcomes"][name] = stats["outcomes"].get(name, 0) + 1
+        except asyncio.TimeoutError:
+            stats["timeouts"] += 1
+        finally:
+            del self.inboxes[user_id]
+
+    async def drive(self, users, ramp, think, timeout):
+        await self.bot_connected.wait()
+        stats = {"photo_to_keyboard": [], "press_to_reply": [], "flow": [], "completed": 0, "auto": 0, "timeouts": 0,
+                 "outcomes": {}}
+        started = time.perf_counter()
+        tasks = []
+        for index in range(users):
+            tasks.append(asyncio.create_task(self.user_flow(1000 + index, think, timeout, stats)))
+            if ramp:
+                await asyncio.sleep(1 / ramp)
+        await asyncio.gather(*tasks)
+        return stats, time.perf_counter() - started
+
+def load_images(directory):
+    images = []
+    for name in sorted(os.listdir(directory)):
+        if name.lower().endswith(IMAGE_EXTENSIONS):
+            with open(os.path.join(directory, name), "rb") as f:
+                images.append((name, f.read()))
+    return images
+
+def report(fake, stats, elapsed, users):
+    print(f"Users: {users}, completed {stats['completed']} ({stats['auto']} auto-detected), "
+          f"timeouts {stats['timeouts']}, in {elapsed:.2f}s")
+    print(f"Outcomes: {stats['outcomes']}")
+    print(f"Updates delivered: {fake.delivered} ({fake.delivered / elapsed if elapsed else 0:.1f}/s), "
+          f"flows/s: {stats['completed'] / elapsed if elapsed else 0:.1f}")
+    print(f"{'step':<20}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for step in ("photo_to_keyboard", "press_to_reply", "flow"):
+        values = stats[step]
+        row = [percentile(values, 50), percentile(values, 95), percentile(values, 99), max(values, default=0)]
+        print(f"{step:<20}" + "".join(f"{value * 1000:>10.1f}" for value in row))
+    print(f"API calls: {dict(sorted(fake.calls.items()))}")
+    print(f"Peak RSS (fake server): {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+
+async def run_async(args):
+    fake = FakeTelegram(load_images(args.corpus), unique_images=args.unique_images)
+    server = await asyncio.start_server(fake.handle_connection, args.host, args.port, limit=2 ** 20)
+    print(f"Fake Telegram Bot API on http://{args.host}:{args.port} - waiting for the bot to poll...")
+    async with server:
+        stats, elapsed = await fake.drive(args.users, args.ramp, args.think, args.timeout)
+        report(fake, stats, elapsed, args.users)
+        if fake.webhook_client is not None:
+            await fake.webhook_client.aclose()
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description="Fake Telegram Bot API with simulated users.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8082)
+    parser.add_argument("--corpus", default=CORPUS_DIR, help="directory of receipt images to send")
+    parser.add_argument("--users", type=int, default=100, help="simulated users, one receipt each")
+    parser.add_argument("--ramp", type=float, default=50, help="new users per second (0 = all at once)")
+    parser.add_argument("--think", type=float, default=1.0, help="max seconds a user waits before pressing a button")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for any bot reply")
+    parser.add_argument("--unique-images", action="store_true", help="make every upload unique so the OCR cache misses")
+    asyncio.run(run_async(parser.parse_args(argv)))
+
+if __name__ == "__main__":
+    run()
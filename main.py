@@ -1,9 +1,26 @@
 import os
-import time
 import re
+import json
+import hmac
+import socket
+import uuid
+import time
+import random
+import zlib
+import sqlite3
+import threading
+import asyncio
 import logging
-import requests
+import hashlib
+import itertools
+import functools
+import multiprocessing
+import contextlib
+import contextvars
+import httpx
 from io import BytesIO
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from dotenv import load_dotenv
 from telegram import (
     Update,
@@ -21,22 +38,559 @@ from telegram.ext import (
     filters,
 )
 
+# Pillow is only needed for PREPROCESS_IMAGES; it is listed in requirements.txt as optional
+try:
+    from PIL import Image, ImageChops, ImageOps
+except ImportError:
+    Image = None
+
 # Load environment variables
 load_dotenv()
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 AZURE_ENDPOINT = os.getenv("AZURE_VISION_ENDPOINT")
 AZURE_KEY = os.getenv("AZURE_VISION_KEY")
 API_URL = AZURE_ENDPOINT + 'vision/v3.2/read/analyze'
+OCR_MAX_CONNECTIONS = int(os.getenv("OCR_MAX_CONNECTIONS", "20"))
+OCR_HTTP_TIMEOUT = float(os.getenv("OCR_HTTP_TIMEOUT", "30"))
+OCR_POLL_MIN_INTERVAL = float(os.getenv("OCR_POLL_MIN_INTERVAL", "0.25"))
+OCR_POLL_MAX_INTERVAL = float(os.getenv("OCR_POLL_MAX_INTERVAL", "2"))
+OCR_POLL_BACKOFF = float(os.getenv("OCR_POLL_BACKOFF", "1.5"))
+OCR_POLL_DEADLINE = float(os.getenv("OCR_POLL_DEADLINE", "30"))
+AZURE_TPS = float(os.getenv("AZURE_TPS", "10"))
+AZURE_BURST = float(os.getenv("AZURE_BURST", "0"))
+OCR_RETRIES = int(os.getenv("OCR_RETRIES", "3"))
+OCR_RETRY_BASE = float(os.getenv("OCR_RETRY_BASE", "0.5"))
+OCR_RETRY_MAX_WAIT = float(os.getenv("OCR_RETRY_MAX_WAIT", "10"))
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", "16"))
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", "8"))
+OCR_QUEUE_LIMIT = int(os.getenv("OCR_QUEUE_LIMIT", "100"))
+OCR_JOB_TIMEOUT = float(os.getenv("OCR_JOB_TIMEOUT", "120"))
+OCR_PROCESSES = int(os.getenv("OCR_PROCESSES", "0"))
+OCR_CACHE_SIZE = int(os.getenv("OCR_CACHE_SIZE", "256"))
+OCR_CACHE_TTL = float(os.getenv("OCR_CACHE_TTL", "86400"))
+OCR_CACHE_DB = os.getenv("OCR_CACHE_DB", "")
+OCR_CACHE_DB_MAX_MB = float(os.getenv("OCR_CACHE_DB_MAX_MB", "200"))
+OCR_CACHE_DB_TTL = float(os.getenv("OCR_CACHE_DB_TTL", str(30 * 86400)))
+SPECULATIVE_OCR = os.getenv("SPECULATIVE_OCR", "1") == "1"
+AUTO_CLASSIFY = os.getenv("AUTO_CLASSIFY", "1") == "1"
+SESSION_TTL = float(os.getenv("SESSION_TTL", "1800"))
+SESSION_MAX_IMAGE_MB = float(os.getenv("SESSION_MAX_IMAGE_MB", "200"))
+SESSION_DB = os.getenv("SESSION_DB", "")
+SHARED_OCR_WAIT = float(os.getenv("SHARED_OCR_WAIT", "30"))
+LAZY_IMAGES = os.getenv("LAZY_IMAGES", "1") == "1"
+ALBUM_WAIT = float(os.getenv("ALBUM_WAIT", "1.5"))
+TELEGRAM_MESSAGE_LIMIT = 4096
+PDF_MAX_PARALLEL_PAGES = int(os.getenv("PDF_MAX_PARALLEL_PAGES", "20"))
+OCR_MIN_PIXELS = int(os.getenv("OCR_MIN_PIXELS", "600000"))
+PREPROCESS_IMAGES = os.getenv("PREPROCESS_IMAGES", "0") == "1"
+PREPROCESS_WORKERS = int(os.getenv("PREPROCESS_WORKERS", "2"))
+PREPROCESS_MAX_SIDE = int(os.getenv("PREPROCESS_MAX_SIDE", "2000"))
+PREPROCESS_QUALITY = int(os.getenv("PREPROCESS_QUALITY", "85"))
+RUN_MODE = os.getenv("RUN_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+TRACE_LOG = os.getenv("TRACE_LOG", "-")
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 
-# In-memory storage
-user_images = {}
-user_state = {}
+# Prometheus text-format metrics without the client library: counters, histograms with
+# fixed buckets, and gauges read at scrape time. OCR worker processes set `buffer` and
+# ship their observations back with each result, where replay() records them.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Metrics:
+    def __init__(self):
+        self.families = {}
+        self.values = {}
+        self.buffer = None
+
+    def counter(self, name, help):
+        self.families[name] = ("counter", help, None)
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        self.families[name] = ("histogram", help, buckets)
+
+    def gauge(self, name, help, read):
+        self.families[name] = ("gauge", help, read)
+
+    def inc(self, name, amount=1, **labels):
+        if self.buffer is not None:
+            self.buffer.append(("inc", name, amount, labels))
+            return
+        key = (name, tuple(sorted(labels.items())))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        if self.buffer is not None:
+            self.buffer.append(("observe", name, value, labels))
+            return
+        buckets = self.families[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        # Cumulative bucket counts, then sum and count
+        counts = self.values.setdefault(key, [0] * (len(buckets) + 2))
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                counts[i] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    @contextlib.contextmanager
+    def time(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def drain(self):
+        events, self.buffer = self.buffer, []
+        return events
+
+    def replay(self, events):
+        for kind, name, value, labels in events:
+            getattr(self, kind)(name, value, **labels)
+
+    def render(self):
+        lines = []
+        for name, (kind, help, extra) in self.families.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "gauge":
+                lines.append(f"{name} {extra()}")
+                continue
+            for (key_name, labels), value in self.values.items():
+                if key_name != name:
+                    continue
+                if kind == "counter":
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+                    continue
+                for bound, count in zip(extra + ("+Inf",), value[:-2] + [value[-1]]):
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {count}")
+                lines.append(f"{name}_sum{format_labels(labels)} {value[-2]}")
+                lines.append(f"{name}_count{format_labels(labels)} {value[-1]}")
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+metrics = Metrics()
+metrics.histogram("bot_download_seconds", "Telegram getFile and file download")
+metrics.histogram("bot_azure_submit_seconds", "Azure Read analyze request")
+metrics.histogram("bot_azure_poll_seconds", "One Azure Read result poll request")
+metrics.histogram("bot_azure_polls", "Result polls per Azure Read job", buckets=(1, 2, 3, 5, 8, 13, 21, 34))
+metrics.histogram("bot_ocr_seconds", "Azure Read job from submit to final status")
+metrics.histogram("bot_extract_seconds", "Field extraction from OCR text", buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01))
+metrics.histogram("bot_reply_edit_seconds", "Editing the Telegram message with the result")
+metrics.counter("bot_azure_requests_total", "Azure Read requests by kind and HTTP status")
+metrics.counter("bot_ocr_jobs_total", "Azure Read jobs by final status")
+metrics.counter("bot_ocr_rejected_total", "OCR jobs refused because the queue was full")
+metrics.counter("bot_ocr_worker_restarts_total", "OCR worker processes that died and were replaced")
+metrics.counter("bot_azure_throttled_total", "Azure Read requests answered with 429")
+metrics.counter("bot_azure_retries_total", "Azure Read submits retried, by HTTP status")
+metrics.histogram("bot_azure_limiter_wait_seconds", "Time an Azure Read request waited for the rate limiter")
+metrics.inc("bot_ocr_rejected_total", 0)
+metrics.inc("bot_ocr_worker_restarts_total", 0)
+metrics.inc("bot_azure_throttled_total", 0)
+
+# Per-receipt tracing: every upload gets a receipt ID that follows it through the session,
+# the OCR queue and worker processes. Each stage writes one JSON line with its duration to
+# TRACE_LOG ("-" for stderr, a file path, or empty to turn tracing off).
+trace_logger = logging.getLogger("receipt_trace")
+trace_logger.propagate = False
+if TRACE_LOG:
+    trace_handler = logging.StreamHandler() if TRACE_LOG == "-" else logging.FileHandler(TRACE_LOG)
+    trace_handler.setFormatter(logging.Formatter("%(message)s"))
+    trace_logger.addHandler(trace_handler)
+    trace_logger.setLevel(logging.INFO)
+else:
+    trace_logger.disabled = True
+
+current_receipt = contextvars.ContextVar("current_receipt", default=None)
+
+def new_receipt_id():
+    return uuid.uuid4().hex[:12]
+
+def trace_event(event, **fields):
+    receipt_id = current_receipt.get()
+    if receipt_id is None or trace_logger.disabled:
+        return
+    record = {"ts": round(time.time(), 3), "receipt": receipt_id, "event": event, **fields}
+    trace_logger.info(json.dumps(record, default=str))
+
+# Timed span; the yielded dict takes attributes known only once the stage has run
+@contextlib.contextmanager
+def span(event, **fields):
+    started = time.perf_counter()
+    try:
+        yield fields
+    except BaseException as e:
+        fields["error"] = type(e).__name__
+        raise
+    finally:
+        trace_event(event, ms=round((time.perf_counter() - started) * 1000, 1), **fields)
+
+# Errors are logged with their receipt ID and recorded in the trace
+def receipt_error(stage, error):
+    message = f"{type(error).__name__}: {error}"
+    logging.error(f"{stage} error (receipt {current_receipt.get()}): {message}")
+    trace_event("error", stage=stage, error=message)
+
+# Last event of a receipt's trace, with the time since upload
+def trace_result(outcome, uploaded=None, **fields):
+    if uploaded is not None:
+        fields["total_ms"] = round((time.time() - uploaded) * 1000, 1)
+    trace_event("result", outcome=outcome, **fields)
+
+# In-memory session store: one pending receipt per user, expiring after SESSION_TTL
+# seconds of inactivity. Image payloads share a byte budget; when it is exceeded the
+# least recently used images are dropped (they can be fetched again by file_id).
+class SessionStore:
+    def __init__(self, ttl, max_image_bytes):
+        self.ttl = ttl
+        self.max_image_bytes = max_image_bytes
+        self.sessions = OrderedDict()
+        self.image_bytes = 0
+        self.expired = 0
+        self.evicted_images = 0
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    # Nothing is shared between processes, so user_lock's in-process lock is enough
+    @contextlib.asynccontextmanager
+    async def lock(self, user_id):
+        yield
+
+    # Async to match SqliteSessionStore, whose queries run off the event loop
+    async def start(self, user_id, image=None, **fields):
+        await self.sweep()
+        await self.discard(user_id)
+        session = dict(fields, image=image, expires=time.monotonic() + self.ttl)
+        self.sessions[user_id] = session
+        if image is not None:
+            self.image_bytes += len(image)
+            self.enforce_budget()
+        return session
+
+    async def get(self, user_id):
+        await self.sweep()
+        session = self.sessions.get(user_id)
+        if session is not None:
+            session["expires"] = time.monotonic() + self.ttl
+            self.sessions.move_to_end(user_id)
+        return session
+
+    async def update(self, user_id, **fields):
+        session = await self.get(user_id)
+        if session is not None:
+            session.update(fields)
+        return session
+
+    async def pop(self, user_id):
+        session = self.sessions.pop(user_id, None)
+        if session is not None and session.get("image") is not None:
+            self.image_bytes -= len(session["image"])
+        return session
+
+    # Like pop, but also cancels the session's OCR job
+    async def discard(self, user_id):
+        session = await self.pop(user_id)
+        job = session.get("ocr") if session else None
+        if job is not None and not job.done():
+            job.cancel()
+
+    def drop_image(self, session):
+        image = session.get("image")
+        if image is not None:
+            self.image_bytes -= len(image)
+            session["image"] = None
+        return image
+
+    async def sweep(self):
+        now = time.monotonic()
+        while self.sessions:
+            user_id, session = next(iter(self.sessions.items()))
+            if session["expires"] > now:
+                break
+            await self.discard(user_id)
+            self.expired += 1
+
+    def enforce_budget(self):
+        for session in self.sessions.values():
+            if self.image_bytes <= self.max_image_bytes:
+                break
+            if self.drop_image(session) is not None:
+                self.evicted_images += 1
+
+    def stats(self):
+        return {
+            "sessions": len(self.sessions),
+            "image_bytes": self.image_bytes,
+            "expired": self.expired,
+            "evicted_images": self.evicted_images,
+        }
+
+# Shared session store for running several bot processes (or hosts on a shared volume)
+# against one SQLite file. Only plain fields are stored: images are re-downloaded by
+# file_id. An OCR future stays with the process that started it; the session records its
+# job id and the owner publishes the outcome to ocr_jobs, where other processes read it.
+# Evaluated per call: workers forked after import must not share an identity
+def instance_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+class SqliteSessionStore:
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.db_lock = threading.Lock()
+        self.lock_lease = 30
+        self.db = None
+        self.executor = None
+        self.jobs = {}
+        self.expired = 0
+        self.count = 0
+
+    # Live sessions as of the last sweep, so the metrics gauge never touches the database
+    def __len__(self):
+        return self.count
+
+    def open(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sessions")
+        self.db = sqlite3.connect(self.path, check_same_thread=False, timeout=5, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, expires REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS session_locks ("
+            "user_id INTEGER PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS ocr_jobs ("
+            "job_id TEXT PRIMARY KEY, status TEXT NOT NULL, text TEXT, expires REAL NOT NULL)"
+        )
+
+    def close(self):
+        with self.db_lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    # (rows, rowcount) of one statement; nothing once the store is closed
+    def query(self, sql, params=()):
+        with self.db_lock:
+            if self.db is None:
+                return [], 0
+            cursor = self.db.execute(sql, params)
+            return cursor.fetchall(), cursor.rowcount
+
+    # Statements run on the store's own thread: while other processes hold the write lock one
+    # can wait up to the 5 s busy timeout, which must not stall the event loop. One thread is
+    # enough as the connection serves a statement at a time anyway.
+    async def run(self, sql, params=()):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.query, sql, params)
+
+    # Per-user lock across processes. The row is leased so a crashed holder cannot block
+    # the user for good, and renewed while held since a handler can keep it for longer than
+    # any fixed lease (a PDF holds it across every page's OCR); within a process user_lock
+    # already lets only one task contend.
+    @contextlib.asynccontextmanager
+    async def lock(self, user_id):
+        while not await self.try_lock(user_id):
+            await asyncio.sleep(0.02)
+        renewal = asyncio.create_task(self.renew_lock(user_id))
+        try:
+            yield
+        finally:
+            renewal.cancel()
+            await self.run("DELETE FROM session_locks WHERE user_id = ? AND owner = ?", (user_id, instance_id()))
+
+    async def renew_lock(self, user_id):
+        while True:
+            await asyncio.sleep(self.lock_lease / 3)
+            try:
+                await self.run(
+                    "UPDATE session_locks SET expires = ? WHERE user_id = ? AND owner = ?",
+                    (time.time() + self.lock_lease, user_id, instance_id()),
+                )
+            except sqlite3.Error as e:
+                logging.warning(f"Session lock renewal failed for user {user_id}: {e}")
+
+    async def try_lock(self, user_id):
+        now = time.time()
+        _, rowcount = await self.run(
+            "INSERT INTO session_locks (user_id, owner, expires) VALUES (?, ?, ?) "
+            "ON CONFLICT (user_id) DO UPDATE SET owner = excluded.owner, expires = excluded.expires "
+            "WHERE session_locks.expires <= ?",
+            (user_id, instance_id(), now + self.lock_lease, now),
+        )
+        return rowcount == 1
+
+    # Merge the local OCR future (if this process owns one) into the stored fields
+    def load(self, user_id, data):
+        session = json.loads(data)
+        session["image"] = None
+        job, job_id, _ = self.jobs.get(user_id, (None, None, None))
+        if job is not None and session.get("ocr_job") == job_id:
+            session["ocr"] = job
+        return session
+
+    # An OCR future cannot be stored: keep it in this process and store its job id instead
+    async def keep_job(self, user_id, fields):
+        job = fields.pop("ocr", None)
+        if job is not None:
+            job_id = uuid.uuid4().hex
+            self.jobs[user_id] = (job, job_id, time.monotonic() + self.ttl)
+            fields["ocr_job"] = job_id
+            await self.run(
+                "INSERT INTO ocr_jobs (job_id, status, expires) VALUES (?, 'running', ?)",
+                (job_id, time.time() + self.ttl),
+            )
+            job.add_done_callback(functools.partial(self.finish_job, job_id))
+        return fields
+
+    # Done callback, so it runs on the loop: the write is handed to a thread without waiting for it
+    def finish_job(self, job_id, job):
+        if job.cancelled():
+            status, text = "cancelled", None
+        elif job.exception() is not None:
+            status, text = "failed", None
+        else:
+            status, text = "done", job.result()
+        asyncio.get_running_loop().run_in_executor(
+            self.executor, self.query, "UPDATE ocr_jobs SET status = ?, text = ? WHERE job_id = ?", (status, text, job_id)
+        )
+
+    # (status, text) of a job started by any process; status is "missing" once it expired
+    async def job_result(self, job_id):
+        rows, _ = await self.run("SELECT status, text FROM ocr_jobs WHERE job_id = ?", (job_id,))
+        return rows[0] if rows else ("missing", None)
+
+    async def start(self, user_id, image=None, **fields):
+        await self.discard(user_id)
+        data = json.dumps(await self.keep_job(user_id, fields))
+        await self.run(
+            "INSERT OR REPLACE INTO sessions (user_id, data, expires) VALUES (?, ?, ?)",
+            (user_id, data, time.time() + self.ttl),
+        )
+        return self.load(user_id, data)
+
+    async def get(self, user_id):
+        rows, _ = await self.run(
+            "UPDATE sessions SET expires = ? WHERE user_id = ? AND expires > ? RETURNING data",
+            (time.time() + self.ttl, user_id, time.time()),
+        )
+        return self.load(user_id, rows[0][0]) if rows else None
+
+    async def update(self, user_id, **fields):
+        data = json.dumps(await self.keep_job(user_id, fields))
+        rows, _ = await self.run(
+            "UPDATE sessions SET data = json_patch(data, ?), expires = ? WHERE user_id = ? AND expires > ? RETURNING data",
+            (data, time.time() + self.ttl, user_id, time.time()),
+        )
+        return self.load(user_id, rows[0][0]) if rows else None
+
+    # Atomic across processes: only one of two racing callbacks gets the session
+    async def pop(self, user_id):
+        rows, _ = await self.run(
+            "DELETE FROM sessions WHERE user_id = ? AND expires > ? RETURNING data", (user_id, time.time())
+        )
+        session = self.load(user_id, rows[0][0]) if rows else None
+        self.jobs.pop(user_id, None)
+        return session
+
+    async def discard(self, user_id):
+        session = await self.pop(user_id)
+        job = session.get("ocr") if session else None
+        if job is not None and not job.done():
+            job.cancel()
+
+    # Only called by sweep_sessions; the other queries already skip expired rows
+    async def sweep(self):
+        _, expired = await self.run("DELETE FROM sessions WHERE expires <= ?", (time.time(),))
+        self.expired += expired
+        await self.run("DELETE FROM ocr_jobs WHERE expires <= ?", (time.time(),))
+        rows, _ = await self.run("SELECT COUNT(*) FROM sessions")
+        self.count = rows[0][0] if rows else 0
+        now = time.monotonic()
+        for user_id, (job, _, expires) in list(self.jobs.items()):
+            if expires <= now:
+                del self.jobs[user_id]
+                if not job.done():
+                    job.cancel()
+
+    def stats(self):
+        return {"sessions": self.count, "local_jobs": len(self.jobs), "expired": self.expired}
+
+# SESSION_DB selects the shared SQLite store; otherwise sessions live in process memory
+if SESSION_DB:
+    sessions = SqliteSessionStore(SESSION_DB, SESSION_TTL)
+else:
+    sessions = SessionStore(SESSION_TTL, SESSION_MAX_IMAGE_MB * 1024 * 1024)
+
+# Periodic sweep so abandoned sessions are freed even when no one else is active
+async def sweep_sessions():
+    while True:
+        await asyncio.sleep(60)
+        # A failed pass (say the shared database stayed locked) is retried next time, not fatal
+        try:
+            await sessions.sweep()
+            logging.info(f"Sessions: {sessions.stats()}")
+        except Exception as e:
+            logging.error(f"Session sweep failed: {e}")
+
+# Per-user locks: different users run in parallel, one user's updates run in order
+user_locks = {}
+
+@contextlib.asynccontextmanager
+async def user_lock(user_id):
+    entry = user_locks.setdefault(user_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0], sessions.lock(user_id):
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del user_locks[user_id]
+
+def per_user(handler):
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        user = update.effective_user
+        if user is None:
+            return await handler(update, context)
+        async with user_lock(user.id):
+            return await handler(update, context)
+    return wrapper
 
 # Start command with visible "Start" button
+@per_user
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await sessions.discard(update.effective_user.id)
     keyboard = [["start"]]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False)
     
@@ -46,17 +600,37 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 # Handle image upload
+@per_user
 async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
+        if update.message.media_group_id:
+            if add_album_photo(update, context):
+                await update.message.reply_text("🖼️ Album received. Collecting receipts...", reply_markup=ReplyKeyboardRemove())
+            return
+
         # Remove custom keyboard when image is received
         await update.message.reply_text("🖼️ Image received. Processing...", reply_markup=ReplyKeyboardRemove())
 
-        photo = update.message.photo[-1]
-        file = await context.bot.get_file(photo.file_id)
-        file_bytes = await file.download_as_bytearray()
+        photo = receipt_file(update.message)
         user_id = update.message.from_user.id
-        user_images[user_id] = file_bytes
-        user_state[user_id] = {"stage": "main_category"}
+        receipt_id = new_receipt_id()
+        current_receipt.set(receipt_id)
+        trace_event("upload", user=user_id, kind="document" if update.message.document else "photo",
+                    bytes=photo.file_size)
+        # With LAZY_IMAGES only the file reference is kept; bytes go straight to OCR
+        fetch = RemoteFile(context.bot, photo.file_id)
+        image = None if LAZY_IMAGES else await fetch()
+        await sessions.start(user_id, image, stage="main_category", file_id=photo.file_id,
+                       file_unique_id=photo.file_unique_id, receipt_id=receipt_id, uploaded=time.time())
+
+        # Start OCR right away so it runs while the user picks a type
+        job = None
+        if SPECULATIVE_OCR:
+            try:
+                job, position = await start_ocr(image or fetch, photo.file_unique_id)
+                await sessions.update(user_id, ocr=job, queue_position=position)
+            except OcrQueueFull:
+                pass
 
         keyboard = InlineKeyboardMarkup([
             [InlineKeyboardButton("\U0001F4B8 UPI", callback_data="upi")],
@@ -64,35 +638,908 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
             [InlineKeyboardButton("\U0001F9FE Printed Invoice", callback_data="printed")],
             [InlineKeyboardButton("\U0001F4C4 Brochure", callback_data="brochure")]
         ])
-        await update.message.reply_text("\U0001F518 Choose the receipt type:", reply_markup=keyboard)
+        message = await update.message.reply_text("\U0001F518 Choose the receipt type:", reply_markup=keyboard)
+
+        if job is not None and AUTO_CLASSIFY:
+            context.application.create_task(auto_classify(message, user_id, job), update=update)
 
     except Exception as e:
-        logging.error(f"Image error: {e}")
+        receipt_error("Image", e)
         await update.message.reply_text("❌ Failed to process image.")
 
-# OCR using Azure
-def extract_text_from_image(image_stream):
+# Smallest photo size that is still big enough to OCR reliably, instead of always the largest
+def select_photo(photos):
+    for photo in sorted(photos, key=lambda size: size.width * size.height):
+        if photo.width * photo.height >= OCR_MIN_PIXELS and min(photo.width, photo.height) >= 50:
+            return photo
+    return max(photos, key=lambda size: size.width * size.height)
+
+# Images sent as documents arrive uncompressed and are used as they are
+def receipt_file(message):
+    if message.document is not None:
+        return message.document
+    return select_photo(message.photo)
+
+# Album photos arrive as separate updates sharing a media_group_id. They are buffered
+# until no new photo has arrived for ALBUM_WAIT seconds, then read together.
+albums = {}
+
+def add_album_photo(update, context):
+    message = update.message
+    key = (message.from_user.id, message.media_group_id)
+    album = albums.get(key)
+    first = album is None
+    if first:
+        album = albums[key] = {"message": message, "photos": [], "timer": None}
+    album["photos"].append(receipt_file(message))
+    if album["timer"] is not None:
+        album["timer"].cancel()
+    album["timer"] = context.application.create_task(flush_album(key, context.bot), update=update)
+    return first
+
+async def read_photo(bot, photo):
+    current_receipt.set(new_receipt_id())
+    trace_event("upload", kind="album", bytes=photo.file_size)
+    job, _ = await start_ocr(RemoteFile(bot, photo.file_id), photo.file_unique_id)
+    return await wait_ocr(job)
+
+async def flush_album(key, bot):
+    await asyncio.sleep(ALBUM_WAIT)
+    album = albums.pop(key)
+    message = album["message"]
+    photos = album["photos"]
+    try:
+        status = await message.reply_text(f"\U0001F9FE Reading {len(photos)} receipts...")
+        texts = await asyncio.gather(*(read_photo(bot, photo) for photo in photos), return_exceptions=True)
+
+        sections = []
+        for i, text in enumerate(texts, 1):
+            header = f"*Receipt {i}/{len(photos)}*\n"
+            if isinstance(text, OcrQueueFull):
+                sections.append(header + "\u23F3 Too many receipts are being processed right now. Please send this one again.")
+            elif isinstance(text, Exception) or not text or len(text.strip()) < 10:
+                sections.append(header + "\U0001F6AB *Image is unclear or unreadable.*")
+            else:
+                category = classify_receipt(text)
+                sections.append(header + format_receipt(category or "Unclassified", text, detected=category is not None))
+
+        chunks = split_message(sections)
+        await status.edit_text(chunks[0], parse_mode='Markdown')
+        for chunk in chunks[1:]:
+            await message.reply_text(chunk, parse_mode='Markdown')
+
+    except Exception as e:
+        logging.error(f"Album error: {e}")
+        await message.reply_text("⚠️ Failed to process album.")
+
+# Join reply sections into as few messages as Telegram's length limit allows
+def split_message(sections, separator="\n\n"):
+    chunks = []
+    for section in sections:
+        section = section[:TELEGRAM_MESSAGE_LIMIT]
+        if chunks and len(chunks[-1]) + len(separator) + len(section) <= TELEGRAM_MESSAGE_LIMIT:
+            chunks[-1] += separator + section
+        else:
+            chunks.append(section)
+    return chunks
+
+async def download_image(bot, file_id):
+    with metrics.time("bot_download_seconds"), span("download"):
+        file = await bot.get_file(file_id)
+        return bytes(await file.download_as_bytearray())
+
+# A Telegram file fetched on demand; OCR worker processes download it themselves by file_id
+class RemoteFile:
+    def __init__(self, bot, file_id):
+        self.bot = bot
+        self.file_id = file_id
+
+    async def __call__(self):
+        return await download_image(self.bot, self.file_id)
+
+# Plain HTTP download for worker processes, which have no Bot instance
+async def fetch_telegram_file(file_id):
+    client = get_http_client()
+    with metrics.time("bot_download_seconds"), span("download"):
+        response = await client.get(f"{TELEGRAM_API_URL}/bot{BOT_TOKEN}/getFile", params={"file_id": file_id})
+        response.raise_for_status()
+        file_path = response.json()["result"]["file_path"]
+        response = await client.get(f"{TELEGRAM_API_URL}/file/bot{BOT_TOKEN}/{file_path}")
+        response.raise_for_status()
+        return response.content
+
+# Shared async HTTP client so all receipts reuse one Azure connection pool
+http_client = None
+
+def get_http_client():
+    global http_client
+    if http_client is None or http_client.is_closed:
+        http_client = httpx.AsyncClient(
+            timeout=OCR_HTTP_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=OCR_MAX_CONNECTIONS,
+                max_keepalive_connections=OCR_MAX_CONNECTIONS,
+            ),
+        )
+    return http_client
+
+async def close_http_client():
+    global http_client
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
+
+# Recent per-job OCR timings, kept for tuning the poller
+ocr_timings = deque(maxlen=200)
+
+# Small images are usually read in well under a second, so poll them sooner
+def initial_poll_interval(image_size):
+    if image_size < 200 * 1024:
+        return OCR_POLL_MIN_INTERVAL
+    if image_size < 1024 * 1024:
+        return OCR_POLL_MIN_INTERVAL * 2
+    return OCR_POLL_MIN_INTERVAL * 4
+
+def retry_after_seconds(response):
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+# Token bucket matched to the Azure subscription's transactions per second (S1 allows 10).
+# Submits and result polls both count, as they do on Azure's side. Each process has its own
+# bucket: with several bot processes, set AZURE_TPS to each one's share. Callers reserve a
+# token and sleep off any deficit, so waiters are served in arrival order.
+class RateLimiter:
+    def __init__(self, rate, burst=0):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        if not self.rate:
+            return
+        self.refill()
+        self.tokens -= 1
+        if self.tokens < 0:
+            wait = -self.tokens / self.rate
+            metrics.observe("bot_azure_limiter_wait_seconds", wait)
+            await asyncio.sleep(wait)
+
+    # A 429 means the bucket ran ahead of Azure's: hold everyone back for `seconds`.
+    # This sets a floor, so concurrent 429s do not add up their pauses.
+    def pause(self, seconds):
+        if not self.rate:
+            return
+        self.refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+azure_limiter = RateLimiter(AZURE_TPS, AZURE_BURST)
+
+# Throttled and transient server errors are retried; anything else is final
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Seconds to wait before retrying a submit, or None to give up. Retry-After is honoured
+# with a little jitter on top; without it the backoff is exponential with full jitter.
+def retry_delay(response, attempt):
+    if response.status_code not in RETRY_STATUSES or attempt >= OCR_RETRIES:
+        return None
+    retry_after = retry_after_seconds(response)
+    if retry_after is not None:
+        if retry_after > OCR_RETRY_MAX_WAIT:
+            return None
+        delay = retry_after + random.uniform(0, OCR_RETRY_BASE)
+    else:
+        delay = random.uniform(0, min(OCR_RETRY_MAX_WAIT, OCR_RETRY_BASE * 2 ** attempt))
+    return delay
+
+async def submit_read(client, headers, params, image_bytes):
+    attempt = 0
+    while True:
+        await azure_limiter.acquire()
+        with metrics.time("bot_azure_submit_seconds"):
+            response = await client.post(API_URL, headers=headers, params=params, content=image_bytes)
+        metrics.inc("bot_azure_requests_total", kind="submit", status=response.status_code)
+        if response.status_code == 429:
+            metrics.inc("bot_azure_throttled_total")
+        delay = retry_delay(response, attempt)
+        if delay is None:
+            return response, attempt
+        if response.status_code == 429:
+            azure_limiter.pause(delay)
+        metrics.inc("bot_azure_retries_total", status=response.status_code)
+        logging.warning(f"Azure Read submit got {response.status_code}, retry {attempt + 1}/{OCR_RETRIES} in {delay:.2f}s")
+        await asyncio.sleep(delay)
+        attempt += 1
+
+# Poll Operation-Location with exponential backoff until done or the deadline passes.
+# A client error other than 429 will not go away by polling again, so it ends the job at once.
+async def poll_read_result(client, operation_url, headers, image_size):
+    deadline = time.monotonic() + OCR_POLL_DEADLINE
+    interval = initial_poll_interval(image_size)
+    wait = interval
+    polls = 0
+    while True:
+        await asyncio.sleep(max(0, min(wait, deadline - time.monotonic())))
+        await azure_limiter.acquire()
+        with metrics.time("bot_azure_poll_seconds"):
+            response = await client.get(operation_url, headers=headers)
+        metrics.inc("bot_azure_requests_total", kind="poll", status=response.status_code)
+        polls += 1
+        if response.status_code == 429:
+            metrics.inc("bot_azure_throttled_total")
+            azure_limiter.pause(retry_after_seconds(response) or interval)
+        result = None
+        if response.status_code == 200:
+            result = response.json()
+            if result.get('status') in ('succeeded', 'failed'):
+                return result['status'], result, polls
+        elif 400 <= response.status_code < 500 and response.status_code != 429:
+            return "error", None, polls
+        if time.monotonic() >= deadline:
+            return "timeout", result, polls
+        interval = min(interval * OCR_POLL_BACKOFF, OCR_POLL_MAX_INTERVAL)
+        wait = max(interval, retry_after_seconds(response) or 0)
+
+# OCR using Azure, returns the raw analyzeResult payload
+# `pages` (e.g. "2") limits a PDF job to those pages
+async def analyze_image(image_bytes, pages=None):
+    client = get_http_client()
     headers = {
         'Ocp-Apim-Subscription-Key': AZURE_KEY,
         'Content-Type': 'application/octet-stream'
     }
-    response = requests.post(API_URL, headers=headers, data=image_stream.getvalue())
+    params = {'pages': pages} if pages else None
+    started = time.monotonic()
+    with span("ocr_submit", bytes=len(image_bytes), pages=pages) as attrs:
+        response, retries = await submit_read(client, headers, params, image_bytes)
+        attrs.update(status=response.status_code, retries=retries)
+    submitted = time.monotonic()
     if response.status_code != 202:
+        metrics.inc("bot_ocr_jobs_total", status="rejected")
+        # Still throttled or down after the retries: not the image's fault, let the user resend it
+        if response.status_code in RETRY_STATUSES:
+            raise OcrUnavailable(f"Azure Read answered {response.status_code}")
         return None
     operation_url = response.headers['Operation-Location']
-    while True:
-        result = requests.get(operation_url, headers=headers).json()
-        if result.get('status') == 'succeeded':
-            break
-        elif result.get('status') == 'failed':
-            return None
-        time.sleep(1)
+    with span("ocr_poll") as attrs:
+        status, result, polls = await poll_read_result(client, operation_url, headers, len(image_bytes))
+        attrs.update(status=status, polls=polls)
+    finished = time.monotonic()
+    metrics.observe("bot_ocr_seconds", finished - started)
+    metrics.observe("bot_azure_polls", polls)
+    metrics.inc("bot_ocr_jobs_total", status=status)
+    ocr_timings.append({
+        "bytes": len(image_bytes),
+        "submit": submitted - started,
+        "poll": finished - submitted,
+        "polls": polls,
+        "status": status,
+    })
+    logging.info(f"OCR {status}: {len(image_bytes)} bytes, submit {submitted - started:.2f}s, "
+                 f"{polls} polls in {finished - submitted:.2f}s")
+    # Only a job Azure finished but could not read means the image is unreadable
+    if status in ("timeout", "error"):
+        raise OcrUnavailable(f"Azure Read job ended with {status}")
+    if status != 'succeeded':
+        return None
+    return result['analyzeResult']
+
+def text_from_result(analyze_result):
     lines = []
-    for read_result in result['analyzeResult']['readResults']:
+    for read_result in analyze_result['readResults']:
         for line in read_result['lines']:
             lines.append(line['text'])
     return "\n".join(lines)
 
+# LRU cache of analyzeResult payloads keyed by image hash, also reachable by Telegram file_unique_id
+class OcrCache:
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.aliases = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, *keys):
+        now = time.monotonic()
+        for key in keys:
+            key = self.aliases.get(key, key)
+            entry = self.entries.get(key)
+            if entry is None:
+                continue
+            if entry[0] < now:
+                self.evict(key)
+                continue
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return None
+
+    def put(self, key, value, alias=None):
+        if key in self.entries:
+            self.evict(key)
+        self.entries[key] = (time.monotonic() + self.ttl, value, alias)
+        if alias:
+            self.aliases[alias] = key
+        while len(self.entries) > self.max_entries:
+            self.evict(next(iter(self.entries)))
+
+    def evict(self, key):
+        _, _, alias = self.entries.pop(key)
+        if alias and self.aliases.get(alias) == key:
+            del self.aliases[alias]
+
+ocr_cache = OcrCache(OCR_CACHE_SIZE, OCR_CACHE_TTL)
+
+# Optional SQLite store of compressed analyzeResult payloads so warm restarts keep their OCR results
+class DiskOcrCache:
+    def __init__(self, path, max_bytes, ttl):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.db = None
+        self.puts = 0
+        self.hits = 0
+        self.misses = 0
+
+    def open(self):
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS ocr_results ("
+            "key TEXT PRIMARY KEY, alias TEXT, payload BLOB NOT NULL, size INTEGER NOT NULL, "
+            "created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS ocr_results_alias ON ocr_results (alias)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS ocr_results_accessed ON ocr_results (accessed)")
+        self.db.commit()
+        self.compact()
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    def get(self, key, alias=None):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT key, payload, created FROM ocr_results WHERE key = ? OR alias = ? LIMIT 1",
+                (key, alias),
+            ).fetchone()
+            now = time.time()
+            if row is None or row[2] + self.ttl < now:
+                self.misses += 1
+                return None
+            self.db.execute("UPDATE ocr_results SET accessed = ? WHERE key = ?", (now, row[0]))
+            self.db.commit()
+            self.hits += 1
+        return json.loads(zlib.decompress(row[1]))
+
+    def put(self, key, value, alias=None):
+        payload = zlib.compress(json.dumps(value, separators=(',', ':')).encode())
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO ocr_results (key, alias, payload, size, created, accessed) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, alias, payload, len(payload), now, now),
+            )
+            self.db.commit()
+            self.puts += 1
+            if self.puts % 50 == 0:
+                self._compact()
+
+    def compact(self):
+        with self.lock:
+            self._compact()
+
+    # Drop expired rows, then least recently used rows until under 90% of the size cap
+    def _compact(self):
+        self.db.execute("DELETE FROM ocr_results WHERE created < ?", (time.time() - self.ttl,))
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM ocr_results").fetchone()[0]
+        if total > self.max_bytes:
+            target = total - self.max_bytes * 0.9
+            freed = 0
+            stale = []
+            for key, size in self.db.execute("SELECT key, size FROM ocr_results ORDER BY accessed"):
+                if freed >= target:
+                    break
+                stale.append((key,))
+                freed += size
+            self.db.executemany("DELETE FROM ocr_results WHERE key = ?", stale)
+        self.db.commit()
+        self.db.execute("PRAGMA incremental_vacuum")
+
+disk_cache = DiskOcrCache(OCR_CACHE_DB, OCR_CACHE_DB_MAX_MB * 1024 * 1024, OCR_CACHE_DB_TTL) if OCR_CACHE_DB else None
+
+def image_digest(image_bytes, pages=None):
+    digest = hashlib.sha256(image_bytes).hexdigest()
+    return f"{digest}:{pages}" if pages else digest
+
+def page_alias(file_unique_id, pages=None):
+    return f"{file_unique_id}:{pages}" if file_unique_id and pages else file_unique_id
+
+# Memory first, then the disk store; disk hits are promoted into memory. The disk store is
+# optional and shared between processes, so its errors (e.g. a busy database) are a miss.
+async def cached_result(digest=None, file_unique_id=None):
+    keys = [key for key in (file_unique_id, digest) if key]
+    analyze_result = ocr_cache.get(*keys)
+    source = "memory"
+    if analyze_result is None and disk_cache is not None:
+        try:
+            analyze_result = await asyncio.to_thread(disk_cache.get, digest, file_unique_id)
+        except sqlite3.Error as e:
+            logging.warning(f"OCR disk cache read failed, treating as a miss: {e}")
+        source = "disk"
+        if analyze_result is not None and digest:
+            ocr_cache.put(digest, analyze_result, file_unique_id)
+    if analyze_result is not None:
+        trace_event("ocr_cache_hit", source=source)
+    return analyze_result
+
+# A failed disk write only loses the warm-restart copy; the result is still returned
+async def store_result(digest, analyze_result, file_unique_id=None):
+    ocr_cache.put(digest, analyze_result, file_unique_id)
+    if disk_cache is not None:
+        try:
+            await asyncio.to_thread(disk_cache.put, digest, analyze_result, file_unique_id)
+        except sqlite3.Error as e:
+            logging.warning(f"OCR disk cache write failed, result not stored: {e}")
+
+async def cached_text(image_bytes=None, file_unique_id=None, pages=None):
+    digest = image_digest(image_bytes, pages) if image_bytes is not None else None
+    analyze_result = await cached_result(digest, page_alias(file_unique_id, pages))
+    return text_from_result(analyze_result) if analyze_result is not None else None
+
+# Image preprocessing before upload (needs Pillow): crop plain borders, grayscale,
+# downscale to PREPROCESS_MAX_SIDE and recompress. Runs in a process pool; returns the
+# new bytes and per-stage timings, or the original bytes if nothing was saved.
+def preprocess_image(image_bytes, max_side, quality):
+    timings = {}
+    started = time.perf_counter()
+
+    def stage(name):
+        nonlocal started
+        now = time.perf_counter()
+        timings[name] = now - started
+        started = now
+
+    image = ImageOps.exif_transpose(Image.open(BytesIO(image_bytes)))
+    stage("decode")
+    image = image.convert("L")
+    stage("grayscale")
+    background = Image.new("L", image.size, image.getpixel((0, 0)))
+    bbox = ImageChops.difference(image, background).point(lambda value: 255 if value > 24 else 0).getbbox()
+    if bbox and (bbox[2] - bbox[0]) >= 50 and (bbox[3] - bbox[1]) >= 50:
+        image = image.crop(bbox)
+    stage("crop")
+    if max(image.size) > max_side:
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+    stage("downscale")
+    output = BytesIO()
+    image.save(output, format="JPEG", quality=quality, optimize=True)
+    stage("encode")
+    processed = output.getvalue()
+    return (processed if len(processed) < len(image_bytes) else image_bytes), timings
+
+preprocess_pool = None
+preprocess_timings = deque(maxlen=200)
+
+# OCR worker processes preprocess on threads instead of spawning processes of their own
+def start_preprocess_pool(executor=ProcessPoolExecutor):
+    global preprocess_pool
+    if not PREPROCESS_IMAGES:
+        return
+    if Image is None:
+        logging.warning("PREPROCESS_IMAGES is set but Pillow is not installed; uploading images as received")
+        return
+    if executor is ProcessPoolExecutor:
+        # Spawned like the OCR worker processes: forking a process that already runs threads can deadlock
+        preprocess_pool = executor(max_workers=PREPROCESS_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        # Start the workers now rather than on the first receipt, which would wait for their imports
+        preprocess_pool.submit(int)
+    else:
+        preprocess_pool = executor(max_workers=PREPROCESS_WORKERS)
+
+def stop_preprocess_pool():
+    global preprocess_pool
+    if preprocess_pool is not None:
+        preprocess_pool.shutdown(cancel_futures=True)
+        preprocess_pool = None
+
+async def preprocess(image_bytes):
+    if preprocess_pool is None:
+        return image_bytes
+    try:
+        with span("preprocess", bytes=len(image_bytes)) as attrs:
+            processed, timings = await asyncio.get_running_loop().run_in_executor(
+                preprocess_pool, preprocess_image, image_bytes, PREPROCESS_MAX_SIDE, PREPROCESS_QUALITY)
+            attrs["bytes_out"] = len(processed)
+    except Exception as e:
+        logging.warning(f"Preprocessing failed, uploading original: {e}")
+        return image_bytes
+    timings.update({"bytes_in": len(image_bytes), "bytes_out": len(processed)})
+    preprocess_timings.append(timings)
+    logging.info(f"Preprocessed {len(image_bytes)} -> {len(processed)} bytes in {sum(v for k, v in timings.items() if not k.startswith('bytes')):.2f}s")
+    return processed
+
+# Cache-fronted OCR: resent images are answered without another Azure round trip.
+# Returns the image's cache key and its analyzeResult (None if unreadable).
+async def ocr_result(image_bytes, file_unique_id=None, pages=None):
+    digest = image_digest(image_bytes, pages)
+    file_unique_id = page_alias(file_unique_id, pages)
+    analyze_result = await cached_result(digest, file_unique_id)
+    if analyze_result is None:
+        # PDFs are sent untouched
+        upload = image_bytes if pages or image_bytes.startswith(b"%PDF") else await preprocess(image_bytes)
+        analyze_result = await analyze_image(upload, pages)
+        if analyze_result is None:
+            return digest, None
+        await store_result(digest, analyze_result, file_unique_id)
+    return digest, analyze_result
+
+async def extract_text_from_image(image_stream, file_unique_id=None, pages=None):
+    _, analyze_result = await ocr_result(image_stream.getvalue(), file_unique_id, pages)
+    return text_from_result(analyze_result) if analyze_result is not None else None
+
+# Bounded OCR worker pool: at most OCR_WORKERS jobs hit Azure at once, the rest wait in the queue
+class OcrQueueFull(Exception):
+    pass
+
+# Azure kept refusing the job; shown to users like a full queue
+class OcrUnavailable(OcrQueueFull):
+    pass
+
+class OcrWorkerPool:
+    # Jobs are submitted as bytes; start_ocr downloads RemoteFiles first
+    remote_fetch = False
+
+    def __init__(self, workers, limit):
+        self.workers = workers
+        self.limit = limit
+        self.queue = None
+        self.tasks = []
+        self.busy = 0
+
+    def start(self):
+        self.queue = asyncio.Queue(maxsize=self.limit)
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    # (waiting, running) job counts
+    def depth(self):
+        return (self.queue.qsize() if self.queue is not None else 0), self.busy
+
+    # Returns the job future and how many jobs are ahead of it (0 if a worker is free).
+    # The job runs in the submitter's context, so its spans keep the receipt ID.
+    def submit(self, image_bytes, file_unique_id=None, pages=None):
+        future = asyncio.get_running_loop().create_future()
+        job = (image_bytes, file_unique_id, pages, future, contextvars.copy_context(), time.perf_counter())
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            metrics.inc("bot_ocr_rejected_total")
+            raise OcrQueueFull()
+        idle = self.workers - self.busy
+        return future, max(0, self.queue.qsize() - idle)
+
+    async def worker(self):
+        while True:
+            image_bytes, file_unique_id, pages, future, context, submitted = await self.queue.get()
+            self.busy += 1
+            task = None
+            try:
+                # Skip jobs abandoned while they were queued
+                if future.done():
+                    continue
+                context.run(trace_event, "queue_wait", ms=round((time.perf_counter() - submitted) * 1000, 1))
+                task = asyncio.create_task(extract_text_from_image(BytesIO(image_bytes), file_unique_id, pages),
+                                           context=context)
+                # Abandoning the receipt mid-flight frees the worker straight away
+                future.add_done_callback(lambda f, task=task: task.cancel() if f.cancelled() else None)
+                await asyncio.wait([task])
+                if not future.done() and not task.cancelled():
+                    if task.exception() is not None:
+                        future.set_exception(task.exception())
+                    else:
+                        future.set_result(task.result())
+            finally:
+                if task is not None and not task.done():
+                    task.cancel()
+                self.busy -= 1
+                self.queue.task_done()
+
+# One OCR worker process with its own job and result queues, and the ids of the jobs it runs
+class OcrProcess:
+    def __init__(self, context, concurrency, tps, burst):
+        self.jobs = context.Queue()
+        self.results = context.Queue()
+        self.running = set()
+        self.process = context.Process(target=ocr_process_main, daemon=True,
+                                       args=(self.jobs, self.results, concurrency, tps, burst))
+        self.reader = None
+
+# OCR in worker processes (OCR_PROCESSES > 0): the Telegram process queues jobs, hands each
+# to the least busy worker with a free slot and resolves the futures. Each worker runs up to
+# `concurrency` jobs at once and does download -> preprocess -> Azure -> text with its own
+# HTTP client and caches. Each result comes back with its analyzeResult, which goes into
+# this process's memory cache so start_ocr answers resent images without a worker; across
+# restarts only OCR_CACHE_DB keeps them. Queues are per worker, so a process that dies cannot
+# leave a shared queue locked; the watcher fails the jobs it was running and starts a replacement.
+class ProcessOcrPool:
+    remote_fetch = True
+
+    def __init__(self, processes, concurrency, limit):
+        self.processes = processes
+        self.concurrency = concurrency
+        self.limit = limit
+        self.context = multiprocessing.get_context("spawn")
+        self.ids = itertools.count(1)
+        self.pending = {}
+        self.backlog = deque()
+        self.workers = []
+        self.watcher = None
+        self.loop = None
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.workers = [self.spawn() for _ in range(self.processes)]
+        self.watcher = asyncio.create_task(self.watch())
+
+    def spawn(self):
+        worker = OcrProcess(self.context, self.concurrency, AZURE_TPS / self.processes, AZURE_BURST / self.processes)
+        worker.process.start()
+        worker.reader = threading.Thread(target=self.read_results, args=(worker,), daemon=True)
+        worker.reader.start()
+        return worker
+
+    async def stop(self):
+        if self.watcher is not None:
+            self.watcher.cancel()
+            self.watcher = None
+        for worker in self.workers:
+            worker.jobs.put(None)
+        await asyncio.to_thread(self.join)
+        for worker in self.workers:
+            worker.results.put(None)
+            await asyncio.to_thread(worker.reader.join)
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+        self.backlog.clear()
+        self.workers = []
+
+    def join(self):
+        for worker in self.workers:
+            worker.process.join(10)
+            if worker.process.is_alive():
+                worker.process.terminate()
+
+    def depth(self):
+        running = sum(len(worker.running) for worker in self.workers)
+        return len(self.pending) - running, running
+
+    # `image` is bytes or a RemoteFile; only the file_id crosses the process boundary
+    def submit(self, image, file_unique_id=None, pages=None):
+        capacity = self.processes * self.concurrency
+        if len(self.pending) >= capacity + self.limit:
+            metrics.inc("bot_ocr_rejected_total")
+            raise OcrQueueFull()
+        job_id = next(self.ids)
+        future = self.loop.create_future()
+        self.pending[job_id] = future
+        payload = image.file_id if isinstance(image, RemoteFile) else image
+        self.backlog.append((job_id, payload, file_unique_id, pages, current_receipt.get(), time.time()))
+        self.dispatch()
+        return future, len(self.backlog)
+
+    # Jobs abandoned while queued are dropped here; ones already running still finish,
+    # so their results land in the caches
+    def dispatch(self):
+        while self.backlog and self.workers:
+            worker = min(self.workers, key=lambda worker: len(worker.running))
+            if len(worker.running) >= self.concurrency:
+                return
+            job = self.backlog.popleft()
+            future = self.pending.get(job[0])
+            if future is None or future.done():
+                self.pending.pop(job[0], None)
+                continue
+            worker.running.add(job[0])
+            worker.jobs.put(job)
+
+    def read_results(self, worker):
+        while True:
+            message = worker.results.get()
+            if message is None:
+                return
+            self.loop.call_soon_threadsafe(self.resolve, worker, *message)
+
+    # `error` is a message, or the OcrUnavailable itself so handlers can tell it apart;
+    # `entry` is the (key, analyzeResult, alias) to cache, None if there is nothing to cache
+    def resolve(self, worker, job_id, text, error, events, entry):
+        metrics.replay(events)
+        if entry is not None:
+            ocr_cache.put(*entry)
+        worker.running.discard(job_id)
+        future = self.pending.pop(job_id, None)
+        if future is not None and not future.done():
+            if error is not None:
+                future.set_exception(error if isinstance(error, Exception) else RuntimeError(error))
+            else:
+                future.set_result(text)
+        self.dispatch()
+
+    # A worker that died (OOM, segfault, kill) fails the jobs it was running and is replaced
+    async def watch(self):
+        while True:
+            await asyncio.sleep(1)
+            for index, worker in enumerate(self.workers):
+                if worker.process.is_alive():
+                    continue
+                logging.error(f"OCR worker process {worker.process.pid} exited with code "
+                              f"{worker.process.exitcode}, failing {len(worker.running)} jobs and restarting it")
+                metrics.inc("bot_ocr_worker_restarts_total")
+                for job_id in worker.running:
+                    future = self.pending.pop(job_id, None)
+                    if future is not None and not future.done():
+                        future.set_exception(OcrUnavailable("OCR worker process died"))
+                worker.results.put(None)
+                self.workers[index] = self.spawn()
+            self.dispatch()
+
+# Worker processes split the subscription's TPS between them
+def ocr_process_main(jobs, results, concurrency, tps, burst):
+    global azure_limiter
+    azure_limiter = RateLimiter(tps, burst)
+    asyncio.run(ocr_process_loop(jobs, results, concurrency))
+
+async def ocr_process_loop(jobs, results, concurrency):
+    if disk_cache is not None:
+        await asyncio.to_thread(disk_cache.open)
+    start_preprocess_pool(ThreadPoolExecutor)
+    metrics.buffer = []
+    slots = asyncio.Semaphore(concurrency)
+    running = set()
+    try:
+        while True:
+            await slots.acquire()
+            job = await asyncio.to_thread(jobs.get)
+            if job is None:
+                break
+            task = asyncio.create_task(run_ocr_job(job, results, slots))
+            running.add(task)
+            task.add_done_callback(running.discard)
+        await asyncio.gather(*running, return_exceptions=True)
+    finally:
+        stop_preprocess_pool()
+        await close_http_client()
+        if disk_cache is not None:
+            disk_cache.close()
+
+async def run_ocr_job(job, results, slots):
+    job_id, image, file_unique_id, pages, receipt_id, submitted = job
+    current_receipt.set(receipt_id)
+    trace_event("queue_wait", ms=round((time.time() - submitted) * 1000, 1), pid=os.getpid())
+    try:
+        alias = page_alias(file_unique_id, pages)
+        key, analyze_result = alias, None
+        if isinstance(image, str):
+            analyze_result = await cached_result(file_unique_id=alias) if alias else None
+            if analyze_result is None:
+                image = await fetch_telegram_file(image)
+        if analyze_result is None:
+            key, analyze_result = await ocr_result(image, file_unique_id, pages)
+        if analyze_result is None:
+            results.put((job_id, None, None, metrics.drain(), None))
+        else:
+            results.put((job_id, text_from_result(analyze_result), None, metrics.drain(), (key, analyze_result, alias)))
+    except Exception as e:
+        receipt_error("OCR worker", e)
+        error = e if isinstance(e, OcrUnavailable) else f"{type(e).__name__}: {e}"
+        results.put((job_id, None, error, metrics.drain(), None))
+    finally:
+        slots.release()
+
+if OCR_PROCESSES:
+    ocr_pool = ProcessOcrPool(OCR_PROCESSES, OCR_WORKERS, OCR_QUEUE_LIMIT)
+else:
+    ocr_pool = OcrWorkerPool(OCR_WORKERS, OCR_QUEUE_LIMIT)
+
+metrics.gauge("bot_sessions", "Receipts waiting for the user to pick a type", lambda: len(sessions))
+metrics.gauge("bot_ocr_queued_jobs", "OCR jobs waiting for a worker", lambda: ocr_pool.depth()[0])
+metrics.gauge("bot_ocr_running_jobs", "OCR jobs being read", lambda: ocr_pool.depth()[1])
+
+# Scrape endpoint for polling mode; the ASGI app serves /metrics itself
+async def handle_metrics_request(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while await reader.readline() not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.split()
+        if len(parts) > 1 and parts[1] == b"/metrics":
+            status, body = "200 OK", metrics.render().encode()
+        else:
+            status, body = "404 Not Found", b"Not Found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def start_metrics_server():
+    if not METRICS_PORT:
+        return None
+    try:
+        server = await asyncio.start_server(handle_metrics_request, METRICS_HOST, METRICS_PORT)
+    except OSError as e:
+        logging.warning(f"Metrics endpoint not started on {METRICS_HOST}:{METRICS_PORT}: {e}")
+        return None
+    logging.info(f"Metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return server
+
+def resolved(value):
+    future = asyncio.get_running_loop().create_future()
+    future.set_result(value)
+    return future
+
+# Future for an image's text, already resolved on a cache hit; raises OcrQueueFull when saturated.
+# `image` may be a coroutine function fetching the bytes, so a file_unique_id hit skips the download.
+async def start_ocr(image, file_unique_id=None, pages=None):
+    if callable(image):
+        text = await cached_text(file_unique_id=file_unique_id, pages=pages) if file_unique_id else None
+        if text is not None:
+            return resolved(text), 0
+        if ocr_pool.remote_fetch:
+            return ocr_pool.submit(image, file_unique_id, pages)
+        image = await image()
+    text = await cached_text(image, file_unique_id, pages)
+    if text is not None:
+        return resolved(text), 0
+    return ocr_pool.submit(image, file_unique_id, pages)
+
+# The session's speculative OCR runs in another process (shared session store): wait for
+# its outcome. None if it failed, was cancelled or takes too long, so the caller reads it again.
+async def shared_ocr(job_id):
+    deadline = time.monotonic() + SHARED_OCR_WAIT
+    while time.monotonic() < deadline:
+        status, text = await sessions.job_result(job_id)
+        if status == "done":
+            return resolved(text)
+        if status != "running":
+            return None
+        await asyncio.sleep(OCR_POLL_MIN_INTERVAL)
+    return None
+
+# Bounded wait for an OCR job, so a lost job cannot hold the user's lock forever. The job is
+# shielded: a speculative job may have another waiter, which must not see it cancelled.
+async def wait_ocr(job):
+    try:
+        return await asyncio.wait_for(asyncio.shield(job), OCR_JOB_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise OcrUnavailable(f"OCR job did not finish in {OCR_JOB_TIMEOUT:.0f}s")
+
 # Field extraction by category
 # def extract_limited_fields(text, category):
 #     lines = text.splitlines()
@@ -125,75 +1572,283 @@ def extract_text_from_image(image_stream):
 #         result += f"• {key}: {value or 'Not Found'}\n"
 #     return result.strip()
 
-def extract_limited_fields(text, category):
-    lines = text.splitlines()
-    fields = {
-        "Amount": "",
-        "Date & Time": "",
-        "Transaction ID": "",
-        "Person Name": "",
-        "UPI ID": ""  # Only for Paytm
-    }
+# Patterns are compiled once at import instead of on every line
+AMOUNT_RE = re.compile(r'₹\s?\d+[\d,.]*')
+DATE_TIME_RE = re.compile(r'\d{1,2}[:.]\d{2}.*\d{2,4}')
+PERSON_NAME_RE = re.compile(r'(To|Paid to|To:|Paid to:|To-)\s*(.+)', re.IGNORECASE)
+UPI_ID_RE = re.compile(r"\b[\w.-]+@[\w.-]+\b")
+NOT_A_NAME_RE = re.compile(r'@|T[0-9A-Z]{10,}|UTR|debited|bank|account|₹', re.IGNORECASE)
+
+# One field of an extraction profile. `group` picks the value out of the match
+# (None keeps the whole line), `contains` is a cheap substring check run before the regex.
+class FieldRule:
+    def __init__(self, label, pattern, group=None, contains=None, min_length=0, fallback_marker=None):
+        self.label = label
+        self.pattern = pattern
+        self.group = group
+        self.contains = contains
+        self.min_length = min_length
+        # If set, a line with this marker and no value makes the next valid line the fallback value
+        self.fallback_marker = fallback_marker
+
+    def find(self, line):
+        if self.contains and self.contains not in line:
+            return None
+        match = self.pattern.search(line)
+        if not match:
+            return None
+        value = line if self.group is None else match.group(self.group).strip()
+        return value if len(value) > self.min_length else None
+
+class ExtractionProfile:
+    def __init__(self, category, rules):
+        self.category = category
+        self.rules = rules
+
+AMOUNT_RULE = FieldRule("Amount", AMOUNT_RE, contains="₹")
+DATE_TIME_RULE = FieldRule("Date & Time", DATE_TIME_RE)
+PERSON_NAME_RULE = FieldRule("Person Name", PERSON_NAME_RE, group=2, min_length=2, fallback_marker="Paid to")
+UPI_ID_RULE = FieldRule("UPI ID", UPI_ID_RE, group=0, contains="@")
+
+# Provider profiles, looked up by category in extract_fields
+EXTRACTION_PROFILES = {}
 
-    paid_to_index = -1
+def register_profile(profile):
+    EXTRACTION_PROFILES[profile.category] = profile
 
+register_profile(ExtractionProfile("PhonePe", [
+    AMOUNT_RULE,
+    DATE_TIME_RULE,
+    FieldRule("Transaction ID", re.compile(r'^T[0-9A-Z]{20,}$')),
+    PERSON_NAME_RULE,
+]))
+register_profile(ExtractionProfile("Paytm", [
+    AMOUNT_RULE,
+    DATE_TIME_RULE,
+    FieldRule("Transaction ID", re.compile(r'^(?:UPI Ref(?:erence)? No[:.]?\s*)?(\d{12})$', re.IGNORECASE), group=1),
+    UPI_ID_RULE,
+    PERSON_NAME_RULE,
+]))
+register_profile(ExtractionProfile("GooglePay", [
+    AMOUNT_RULE,
+    FieldRule("Date & Time", re.compile(r'\d{1,2}[:.]\d{2}.*\d{2,4}|\b\d{1,2} [A-Za-z]{3,9},? \d{4}')),
+    FieldRule("Transaction ID", re.compile(r'^(?:UPI transaction ID[:.]?\s*)?(\d{12})$', re.IGNORECASE), group=1),
+    PERSON_NAME_RULE,
+]))
+register_profile(ExtractionProfile("Bank", [
+    FieldRule("Amount", re.compile(r'(?:₹|Rs\.?|INR)\s?\d+[\d,.]*', re.IGNORECASE)),
+    FieldRule("Date & Time", re.compile(r'\b\d{1,2}[-/ ](?:\d{1,2}|[A-Za-z]{3})[-/ ]\d{2,4}\b')),
+    FieldRule("Transaction ID", re.compile(r'(?:UTR|Ref(?:erence)?|Txn ?ID)(?:\.? ?No\.?)?[:\s-]*([A-Z0-9]{8,})', re.IGNORECASE), group=1),
+    FieldRule("Account", re.compile(r'A/?c(?:count)?\.? ?No[:.\s-]*([X*\d]{4,})', re.IGNORECASE), group=1),
+]))
+
+# Structured extraction result, rendered to the Telegram reply by format()
+class ExtractionResult:
+    def __init__(self, category, fields):
+        self.category = category
+        self.fields = fields
+
+    def format(self):
+        result = f"\U0001F50D *Extracted Details for {self.category}:*\n"
+        for key, value in self.fields.items():
+            result += f"• {key}: {value or 'Not Found'}\n"
+        return result.strip()
+
+# Single pass over the OCR lines. Each line fills at most one field: the first
+# unfilled rule that matches, in profile order. A rule with a fallback marker
+# claims every line while it is unfilled, as the original elif chain did.
+def extract_fields(text, category):
+    profile = EXTRACTION_PROFILES.get(category) or EXTRACTION_PROFILES["PhonePe"]
+    fields = {rule.label: "" for rule in profile.rules}
+
+    fallback_rule = None
+    fallback_index = -1
+    fallback_value = ""
+
+    lines = text.splitlines()
     for i, line in enumerate(lines):
         line = line.strip()
-        if not fields["Amount"] and re.search(r'₹\s?\d+[\d,.]*', line):
-            fields["Amount"] = line
-
-        elif not fields["Date & Time"] and re.search(r'\d{1,2}[:.]\d{2}.*\d{2,4}', line):
-            fields["Date & Time"] = line
-
-        elif not fields["Transaction ID"] and re.match(r'^T[0-9A-Z]{20,}$', line):
-            fields["Transaction ID"] = line
-
-        elif not fields["Person Name"]:
-            # Direct match like "Paid to: XYZ"
-            match = re.search(r'(To|Paid to|To:|Paid to:|To-)\s*(.+)', line, re.IGNORECASE)
-            if match and len(match.group(2).strip()) > 2:
-                fields["Person Name"] = match.group(2).strip()
-            elif "Paid to" in line and i + 1 < len(lines):
-                paid_to_index = i + 1
-
-        elif category == "Paytm" and not fields["UPI ID"] and "@" in line:
-            upi_match = re.search(r"\b[\w.-]+@[\w.-]+\b", line)
-            if upi_match:
-                fields["UPI ID"] = upi_match.group(0).strip()
-
-    # Use next valid line if "Paid to" was on its own
-    if not fields["Person Name"] and paid_to_index != -1:
-        for j in range(paid_to_index, len(lines)):
-            possible_name = lines[j].strip()
-            if (len(possible_name) > 2 and
-                not re.search(r'@|T[0-9A-Z]{10,}|UTR|debited|bank|account|₹', possible_name, re.IGNORECASE)):
-                fields["Person Name"] = possible_name
+
+        # Next valid line after a bare marker such as "Paid to"
+        if (fallback_index != -1 and not fallback_value and i >= fallback_index and
+                len(line) > 2 and not NOT_A_NAME_RE.search(line)):
+            fallback_value = line
+
+        for rule in profile.rules:
+            if fields[rule.label]:
+                continue
+            value = rule.find(line)
+            if value:
+                fields[rule.label] = value
                 break
+            if rule.fallback_marker:
+                if rule.fallback_marker in line and i + 1 < len(lines):
+                    fallback_rule = rule
+                    fallback_index = i + 1
+                    fallback_value = ""
+                break
+
+    if fallback_rule is not None and not fields[fallback_rule.label]:
+        fields[fallback_rule.label] = fallback_value
+    return ExtractionResult(category, fields)
+
+def extract_limited_fields(text, category):
+    with metrics.time("bot_extract_seconds"), span("extract", category=category):
+        return extract_fields(text, category).format()
+
+# Keyword scoring over the OCR text to detect the receipt provider without asking the user
+CLASSIFIER_RULES = [
+    ("PhonePe", re.compile(r'phone ?pe', re.IGNORECASE), 3),
+    ("PhonePe", re.compile(r'^T[0-9A-Z]{20,}$', re.MULTILINE), 2),
+    ("PhonePe", re.compile(r'@ybl\b|@ibl\b|@axl\b', re.IGNORECASE), 1),
+    ("Paytm", re.compile(r'paytm', re.IGNORECASE), 3),
+    ("Paytm", re.compile(r'UPI Ref(?:erence)? No', re.IGNORECASE), 1),
+    ("GooglePay", re.compile(r'\bG ?Pay\b|Google Pay', re.IGNORECASE), 3),
+    ("GooglePay", re.compile(r'(?:UPI|Google) transaction ID', re.IGNORECASE), 2),
+    ("GooglePay", re.compile(r'@ok(?:axis|hdfcbank|icici|sbi)\b', re.IGNORECASE), 1),
+    ("Bank", re.compile(r'\bA/?c(?:count)?\.? ?No\b|\bIFSC\b', re.IGNORECASE), 2),
+    ("Bank", re.compile(r'\b(?:NEFT|RTGS|IMPS|UTR)\b'), 1),
+    ("Bank", re.compile(r'statement|branch', re.IGNORECASE), 1),
+]
+CLASSIFIER_MIN_SCORE = 3
+
+def classify_receipt(text):
+    scores = {}
+    for category, pattern, weight in CLASSIFIER_RULES:
+        if pattern.search(text):
+            scores[category] = scores.get(category, 0) + weight
+    if not scores:
+        return None
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    best, score = ranked[0]
+    if score < CLASSIFIER_MIN_SCORE or (len(ranked) > 1 and ranked[1][1] == score):
+        return None
+    return best
 
-    result = f"\U0001F50D *Extracted Details for {category}:*\n"
-    for key, value in fields.items():
-        if category != "Paytm" and key == "UPI ID":
-            continue
-        result += f"• {key}: {value or 'Not Found'}\n"
-    return result.strip()
+def format_receipt(category, text, detected=False):
+    formatted = extract_limited_fields(text, category) if category in EXTRACTION_PROFILES else f"\U0001F4C4 *Raw Text:*\n{text}"
+    suffix = " _(auto-detected)_" if detected else ""
+    return f"\u2705 *Category:* `{category}`{suffix}\n\n{formatted}"
+
+# Answer the receipt directly once speculative OCR finishes, if the provider is recognisable
+async def auto_classify(message, user_id, job):
+    try:
+        text = await wait_ocr(job)
+    except (asyncio.CancelledError, Exception):
+        return
+    if not text or len(text.strip()) < 10:
+        return
+    category = classify_receipt(text)
+    if category is None:
+        return
+    # The reply is sent under the lock too, so a button pressed meanwhile sees the result first
+    async with user_lock(user_id):
+        session = await sessions.get(user_id)
+        if session is None or session.get("ocr") is not job:
+            return
+        await sessions.pop(user_id)
+        try:
+            reply = format_receipt(category, text, detected=True)
+            with metrics.time("bot_reply_edit_seconds"), span("reply"):
+                await message.edit_text(reply, parse_mode='Markdown')
+            trace_result("answered", session.get("uploaded"), category=category, detected=True)
+        except Exception as e:
+            receipt_error("Auto-classify reply", e)
+
+# Page count from the PDF page tree; None if it cannot be read cheaply (e.g. compressed object streams).
+# Only the root /Pages node's /Count is used (outlines have a /Count too), and it must agree with
+# the number of page objects found; otherwise the document is read as one job.
+PDF_OBJECT_RE = re.compile(rb'\d+\s+\d+\s+obj\b(.*?)\bendobj', re.DOTALL)
+PDF_COUNT_RE = re.compile(rb'/Count\s+(\d+)')
+PDF_PAGES_RE = re.compile(rb'/Type\s*/Pages(?!\w)')
+PDF_PAGE_RE = re.compile(rb'/Type\s*/Page(?![s\w])')
+
+def pdf_page_count(data):
+    root = None
+    leaves = 0
+    for body in PDF_OBJECT_RE.findall(data):
+        if PDF_PAGES_RE.search(body):
+            count = PDF_COUNT_RE.search(body)
+            if count and b"/Parent" not in body:
+                root = int(count.group(1))
+        elif PDF_PAGE_RE.search(body):
+            leaves += 1
+    if root is None:
+        return leaves or None
+    if leaves and leaves != root:
+        return None
+    return root or None
+
+def format_page(text, page, pages):
+    header = f"\U0001F4C4 *Page {page}/{pages}*\n" if pages > 1 else ""
+    if not text or len(text.strip()) < 10:
+        return header + "\U0001F6AB *Page is unclear or unreadable.*"
+    category = classify_receipt(text)
+    return header + format_receipt(category or "Unclassified", text, detected=category is not None)
+
+async def read_pdf_page(data, file_unique_id, page):
+    job, _ = await start_ocr(data, file_unique_id, pages=str(page))
+    return page, await wait_ocr(job)
+
+# PDF receipts: each page is its own Read job so pages run in parallel, and each page
+# is replied to as soon as it is read. Unknown or very long documents go as one job.
+@per_user
+async def handle_pdf(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        document = update.message.document
+        uploaded = time.time()
+        current_receipt.set(new_receipt_id())
+        trace_event("upload", user=update.message.from_user.id, kind="pdf", bytes=document.file_size)
+        await update.message.reply_text("📄 PDF received. Reading...", reply_markup=ReplyKeyboardRemove())
+        data = await download_image(context.bot, document.file_id)
+        # A regex scan of up to 20 MB: run it off the event loop
+        pages = await asyncio.to_thread(pdf_page_count, data)
+
+        if pages and 1 < pages <= PDF_MAX_PARALLEL_PAGES:
+            reads = [read_pdf_page(data, document.file_unique_id, page) for page in range(1, pages + 1)]
+            skipped = 0
+            for read in asyncio.as_completed(reads):
+                try:
+                    page, text = await read
+                except OcrQueueFull:
+                    skipped += 1
+                    continue
+                for chunk in split_message([format_page(text, page, pages)]):
+                    await update.message.reply_text(chunk, parse_mode='Markdown')
+            if skipped:
+                await update.message.reply_text(f"\u23F3 Too many receipts are being processed right now. {skipped} of {pages} pages were skipped, please send the PDF again in a minute.")
+        else:
+            job, _ = await start_ocr(data, document.file_unique_id)
+            text = await wait_ocr(job)
+            for chunk in split_message([format_page(text, 1, 1)]):
+                await update.message.reply_text(chunk, parse_mode='Markdown')
+        trace_result("answered", uploaded, pages=pages)
+
+    except OcrQueueFull:
+        trace_result("rejected")
+        await update.message.reply_text("\u23F3 Too many receipts are being processed right now. Please send the PDF again in a minute.")
+    except Exception as e:
+        receipt_error("PDF", e)
+        await update.message.reply_text("⚠️ Failed to process PDF.")
 
 # Callback handler for buttons
+@per_user
 async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
     data = query.data
 
-    if user_id not in user_images:
+    session = await sessions.get(user_id)
+    if session is None:
         await query.edit_message_text("❌ Please send a receipt image first.")
         return
 
-    state = user_state.get(user_id, {})
-    stage = state.get("stage")
+    stage = session.get("stage")
 
     if stage == "main_category":
         if data == "upi":
-            user_state[user_id]["stage"] = "upi_subtype"
+            await sessions.update(user_id, stage="upi_subtype")
             keyboard = InlineKeyboardMarkup([
                 [InlineKeyboardButton("\U0001F7E3 PhonePe", callback_data="PhonePe"),
                  InlineKeyboardButton("\U0001F537 Paytm", callback_data="Paytm"),
@@ -201,37 +1856,188 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             ])
             await query.edit_message_text("\U0001F4B3 Choose UPI type:", reply_markup=keyboard)
         else:
-            user_state[user_id]["stage"] = "final"
             await process_receipt(query, user_id, category=data)
 
     elif stage == "upi_subtype":
-        user_state[user_id]["stage"] = "final"
         await process_receipt(query, user_id, category=data)
 
 # Final process step
 async def process_receipt(query, user_id, category):
     try:
-        image_stream = BytesIO(user_images.pop(user_id))
-        text = extract_text_from_image(image_stream)
+        session = await sessions.pop(user_id)
+        if session is None:
+            return
+        current_receipt.set(session.get("receipt_id"))
+        job = session.get("ocr")
+        position = session.get("queue_position", 0)
+        if job is None and session.get("ocr_job"):
+            job = await shared_ocr(session["ocr_job"])
+        if job is None:
+            fetch = RemoteFile(query.get_bot(), session["file_id"])
+            try:
+                job, position = await start_ocr(session["image"] or fetch, session["file_unique_id"])
+            except OcrQueueFull:
+                trace_result("rejected", session.get("uploaded"))
+                await query.edit_message_text("\u23F3 Too many receipts are being processed right now. Please send it again in a minute.")
+                return
+        # The position is from when the job was queued, possibly at upload; only shown while it still waits
+        if position and not job.done():
+            await query.edit_message_text(f"\u23F3 You are #{position} in the queue. Your receipt will be read shortly...")
+        # Time the user waits for OCR after choosing the type; near zero when speculative OCR finished first
+        with span("ocr_wait"):
+            text = await wait_ocr(job)
 
         if not text or len(text.strip()) < 10:
             await query.edit_message_text("\U0001F6AB *Image is unclear or unreadable.* Please upload a better receipt.", parse_mode='Markdown')
+            trace_result("unreadable", session.get("uploaded"))
             return
 
-        formatted = extract_limited_fields(text, category) if category in ["PhonePe", "Paytm", "GooglePay"] else f"\U0001F4C4 *Raw Text:*\n{text}"
-
-        await query.edit_message_text(f"\u2705 *Category:* `{category}`\n\n{formatted}", parse_mode='Markdown')
+        reply = format_receipt(category, text)
+        with metrics.time("bot_reply_edit_seconds"), span("reply"):
+            await query.edit_message_text(reply, parse_mode='Markdown')
+        trace_result("answered", session.get("uploaded"), category=category)
 
+    except OcrUnavailable as e:
+        receipt_error("Processing", e)
+        await query.edit_message_text("\u23F3 Too many receipts are being processed right now. Please send it again in a minute.")
     except Exception as e:
-        logging.error(f"Processing error: {e}")
+        receipt_error("Processing", e)
         await query.edit_message_text("⚠️ Failed to process receipt.")
 
+# Application lifecycle hooks
+async def on_startup(application):
+    if disk_cache is not None:
+        await asyncio.to_thread(disk_cache.open)
+    await asyncio.to_thread(sessions.open)
+    # With worker processes, preprocessing happens there
+    if not OCR_PROCESSES:
+        start_preprocess_pool()
+    ocr_pool.start()
+    application.bot_data["session_sweeper"] = asyncio.create_task(sweep_sessions())
+    application.bot_data["metrics_server"] = await start_metrics_server()
+
+async def on_shutdown(application):
+    sweeper = application.bot_data.pop("session_sweeper", None)
+    if sweeper is not None:
+        sweeper.cancel()
+    metrics_server = application.bot_data.pop("metrics_server", None)
+    if metrics_server is not None:
+        metrics_server.close()
+    await ocr_pool.stop()
+    stop_preprocess_pool()
+    await close_http_client()
+    if disk_cache is not None:
+        disk_cache.close()
+    await asyncio.to_thread(sessions.close)
+
+# Build the application; webhook servers other than PTB's own feed updates in themselves
+def build_application(updater=True):
+    builder = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .connection_pool_size(TELEGRAM_POOL_SIZE)
+        .base_url(f"{TELEGRAM_API_URL}/bot")
+        .base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if not updater:
+        builder = builder.updater(None)
+    application = builder.build()
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(MessageHandler(filters.PHOTO, handle_image))
+    application.add_handler(MessageHandler(filters.Document.IMAGE | filters.Document.FileExtension("jfif"), handle_image))
+    application.add_handler(MessageHandler(filters.Document.PDF, handle_pdf))
+    application.add_handler(CallbackQueryHandler(handle_callback))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, start))  # fallback to restart
+    return application
+
+def webhook_url():
+    return f"{WEBHOOK_URL}/{WEBHOOK_PATH}" if WEBHOOK_URL else None
+
+# ASGI entry point for serving the webhook behind uvicorn/hypercorn and a load balancer:
+#   WEBHOOK_URL=https://bot.example.com uvicorn main:asgi --host 0.0.0.0 --port 8443
+# Telegram POSTs updates to /<WEBHOOK_PATH>; GET /healthz is for the load balancer and
+# GET /metrics answers for whichever worker process the request lands on.
+asgi_application = None
+
+async def asgi(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await asgi_lifespan(receive, send)
+    elif scope["type"] == "http":
+        await asgi_request(scope, receive, send)
+
+async def asgi_lifespan(receive, send):
+    global asgi_application
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            asgi_application = build_application(updater=False)
+            await asgi_application.initialize()
+            await on_startup(asgi_application)
+            if WEBHOOK_URL:
+                await asgi_application.bot.set_webhook(
+                    webhook_url(), secret_token=WEBHOOK_SECRET, max_connections=WEBHOOK_MAX_CONNECTIONS
+                )
+            await asgi_application.start()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await asgi_application.stop()
+            await asgi_application.shutdown()
+            await on_shutdown(asgi_application)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def asgi_request(scope, receive, send):
+    status, body = 404, b"Not Found"
+    if scope["method"] == "GET" and scope["path"] == "/healthz":
+        status, body = 200, b"ok"
+    elif scope["method"] == "GET" and scope["path"] == "/metrics":
+        status, body = 200, metrics.render().encode()
+    elif scope["method"] == "POST" and scope["path"].strip("/") == WEBHOOK_PATH:
+        headers = dict(scope["headers"])
+        # Compared as bytes: the header comes from unauthenticated clients and need not be ASCII
+        token = headers.get(b"x-telegram-bot-api-secret-token", b"")
+        if WEBHOOK_SECRET and not hmac.compare_digest(token, WEBHOOK_SECRET.encode()):
+            status, body = 403, b"Forbidden"
+        else:
+            payload = b""
+            more_body = True
+            while more_body:
+                message = await receive()
+                payload += message.get("body", b"")
+                more_body = message.get("more_body", False)
+            # Anything but an update object is rejected here, not left to fail in the handlers
+            try:
+                data = json.loads(payload)
+                if not isinstance(data, dict) or "update_id" not in data:
+                    raise ValueError("not a Telegram update")
+                update = Update.de_json(data, asgi_application.bot)
+            except Exception as e:
+                logging.warning(f"Rejected webhook payload: {e!r}")
+                status, body = 400, b"Bad Request"
+            else:
+                await asgi_application.update_queue.put(update)
+                status, body = 200, b""
+    await send({"type": "http.response.start", "status": status, "headers": [(b"content-type", b"text/plain")]})
+    await send({"type": "http.response.body", "body": body})
+
 # Entry point
 if __name__ == "__main__":
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(MessageHandler(filters.PHOTO, handle_image))
-    app.add_handler(CallbackQueryHandler(handle_callback))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, start))  # fallback to restart
+    # Without it PTB would register the listen address (https://0.0.0.0:8443/...) with Telegram
+    if RUN_MODE == "webhook" and not WEBHOOK_URL:
+        raise SystemExit("RUN_MODE=webhook needs WEBHOOK_URL, the public HTTPS address Telegram should call")
+    app = build_application()
     print("✅ Bot is running...")
-    app.run_polling()
+    if RUN_MODE == "webhook":
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=webhook_url(),
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+    else:
+        app.run_polling()
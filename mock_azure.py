@@ -0,0 +1,235 @@
+import os
+import json
+import time
+import uuid
+import random
+import hashlib
+import argparse
+import threading
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for the Azure Read API (vision/v3.2/read/analyze + Operation-Location
+# polling) for load testing the bot without spending quota. Recorded analyzeResult JSON
+# is replayed by SHA-256 of the uploaded bytes; other images get synthetic receipt text.
+#
+#   python mock_azure.py --port 8081 --latency 2 --tps 10 --failure-rate 0.02
+#   AZURE_VISION_ENDPOINT=http://127.0.0.1:8081/ python main.py
+
+ANALYZE_PATH = "/vision/v3.2/read/analyze"
+RESULTS_PATH = "/vision/v3.2/read/analyzeResults/"
+
+def load_recordings(directory):
+    recordings = {}
+    if directory and os.path.isdir(directory):
+        for name in os.listdir(directory):
+            if name.endswith(".json"):
+                with open(os.path.join(directory, name)) as f:
+                    recordings[name[:-5]] = json.load(f)
+    return recordings
+
+# Plausible UPI receipt text for images without a recording, stable per image
+def synthetic_result(digest):
+    rng = random.Random(digest)
+    lines = [
+        rng.choice(["PhonePe", "Paytm", "G Pay"]),
+        "Paid to",
+        rng.choice(["Ravi Kumar", "Sita Devi", "Bariflo Labs"]),
+        f"₹ {rng.randint(10, 50000):,}.00",
+        f"{rng.randint(1, 12)}:{rng.randint(0, 59):02d} pm on {rng.randint(1, 28):02d} May 2025",
+        "T" + "".join(rng.choice("0123456789ABCDEF") for _ in range(22)),
+        "UTR: " + "".join(rng.choice("0123456789") for _ in range(12)),
+    ]
+    return {"readResults": [{"page": 1, "lines": [{"text": line} for line in lines]}]}
+
+def error_body(code, message):
+    return {"error": {"code": code, "message": message}}
+
+# Requests per second allowed by the simulated pricing tier
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Returns 0 if a token was taken, otherwise seconds until one is available
+    def take(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+# Transport-independent core, shared by the HTTP server below and bench.py's in-process stub.
+# handle() returns (status, headers, json body or None).
+class MockReadApi:
+    def __init__(self, recordings=None, latency=1.5, jitter=0.3, tps=0, failure_rate=0.0,
+                 error_rate=0.0, throttle_polls=False, key=None, base_url="http://127.0.0.1:8081"):
+        self.recordings = recordings or {}
+        self.latency = latency
+        self.jitter = jitter
+        self.bucket = TokenBucket(tps) if tps else None
+        self.failure_rate = failure_rate
+        self.error_rate = error_rate
+        self.throttle_polls = throttle_polls
+        self.key = key
+        self.base_url = base_url.rstrip("/")
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.counters = {"submitted": 0, "polls": 0, "throttled": 0, "errors": 0, "failed": 0, "succeeded": 0}
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def throttle(self):
+        if self.bucket is None:
+            return None
+        wait = self.bucket.take()
+        if not wait:
+            return None
+        self.count("throttled")
+        retry_after = max(1, round(wait))
+        body = error_body("429", "Requests to the Read Operation have exceeded the rate limit of your current tier.")
+        return 429, {"Retry-After": str(retry_after)}, body
+
+    def handle(self, method, path, query, headers, body):
+        if self.key and headers.get("Ocp-Apim-Subscription-Key") != self.key:
+            return 401, {}, error_body("401", "Access denied due to invalid subscription key.")
+        if method == "POST" and path == ANALYZE_PATH:
+            return self.submit(query, body)
+        if method == "GET" and path.startswith(RESULTS_PATH):
+            return self.poll(path[len(RESULTS_PATH):])
+        return 404, {}, error_body("404", "Resource not found")
+
+    def submit(self, query, body):
+        throttled = self.throttle()
+        if throttled:
+            return throttled
+        if not body:
+            return 400, {}, error_body("InvalidImage", "The input data is not a valid image or PDF.")
+        if random.random() < self.error_rate:
+            self.count("errors")
+            return 503, {"Retry-After": "1"}, error_body("ServiceUnavailable", "The service is temporarily unavailable.")
+
+        digest = hashlib.sha256(body).hexdigest()
+        analyze_result = self.recordings.get(digest) or synthetic_result(digest)
+        pages = query.get("pages")
+        if pages and pages.isdigit():
+            page = int(pages)
+            selected = [result for result in analyze_result["readResults"] if result.get("page", 1) == page]
+            analyze_result = dict(analyze_result, readResults=selected or analyze_result["readResults"][:1])
+
+        job_id = str(uuid.uuid4())
+        now = time.monotonic()
+        duration = self.latency * random.uniform(1 - self.jitter, 1 + self.jitter)
+        with self.lock:
+            self.jobs[job_id] = {
+                "started": now + min(0.1, duration / 4),
+                "ready": now + duration,
+                "failed": random.random() < self.failure_rate,
+                "result": analyze_result,
+            }
+        self.count("submitted")
+        return 202, {"Operation-Location": f"{self.base_url}{RESULTS_PATH}{job_id}"}, None
+
+    def poll(self, job_id):
+        if self.throttle_polls:
+            throttled = self.throttle()
+            if throttled:
+                return throttled
+        self.count("polls")
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            return 404, {}, error_body("404", "Operation not found")
+        now = time.monotonic()
+        if now < job["started"]:
+            return 200, {}, {"status": "notStarted"}
+        if now < job["ready"]:
+            return 200, {}, {"status": "running"}
+        with self.lock:
+            self.jobs.pop(job_id, None)
+        if job["failed"]:
+            self.count("failed")
+            return 200, {}, {"status": "failed"}
+        self.count("succeeded")
+        return 200, {}, {"status": "succeeded", "analyzeResult": job["result"]}
+
+class MockReadHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    api = None
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def dispatch(self, method):
+        url = urlsplit(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        status, headers, payload = self.api.handle(method, url.path, query, self.headers, body)
+        data = json.dumps(payload).encode() if payload is not None else b""
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if payload is not None:
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(api, host, port):
+    handler = type("Handler", (MockReadHandler,), {"api": api})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description="Local mock of the Azure Read API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--recordings", default="", help="directory of recorded analyzeResult JSON, named <sha256>.json")
+    parser.add_argument("--latency", type=float, default=1.5, help="mean job duration in seconds")
+    parser.add_argument("--jitter", type=float, default=0.3, help="relative +/- jitter on the job duration")
+    parser.add_argument("--tps", type=float, default=0, help="transactions per second before 429s (0 = unlimited)")
+    parser.add_argument("--throttle-polls", action="store_true", help="count result polls against --tps too")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of jobs ending with status 'failed'")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of submits answered with 503")
+    parser.add_argument("--key", default=None, help="require this Ocp-Apim-Subscription-Key")
+    args = parser.parse_args(argv)
+
+    api = MockReadApi(
+        recordings=load_recordings(args.recordings),
+        latency=args.latency,
+        jitter=args.jitter,
+        tps=args.tps,
+        failure_rate=args.failure_rate,
+        error_rate=args.error_rate,
+        throttle_polls=args.throttle_polls,
+        key=args.key,
+        base_url=f"http://{args.host}:{args.port}",
+    )
+    server = serve(api, args.host, args.port)
+    print(f"Mock Azure Read API on http://{args.host}:{args.port}/ ({len(api.recordings)} recordings)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Counters: {api.counters}")
+
+if __name__ == "__main__":
+    run()